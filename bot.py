@@ -1,23 +1,43 @@
+import time
+STARTUP_T0 = time.perf_counter()  # process start reference for the startup timing breakdown
+
 import os
+import sys
 import logging
 import uuid
 import asyncio
 import re
+import contextlib
+import contextvars
+import json
+import signal
+import functools
+import hashlib
+import hmac
 from datetime import datetime, timedelta
-from typing import Optional
+from http import HTTPStatus
+from decimal import Decimal
+from typing import Awaitable, Callable, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    BaseUpdateProcessor,
     ContextTypes,
     filters,
     ConversationHandler,
+    BasePersistence,
+    PersistenceInput,
 )
 import asyncpg
 from dotenv import load_dotenv
 
+STARTUP_IMPORTS = time.perf_counter() - STARTUP_T0
+
 # Load environment variables
 load_dotenv()
 
@@ -36,6 +56,31 @@ DB_PASS = os.getenv("DB_PASS")
 DB_NAME = os.getenv("DB_NAME")
 ADMIN_IDS = [int(a) for a in os.getenv("ADMIN_IDS", "1240179115").split(",") if a]
 
+# Serving mode: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Public base URL Telegram should post to; leave empty to serve locally without
+# registering the webhook (e.g. for fake_update.py). Local mode only listens on 127.0.0.1.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Required in webhook mode: posted updates are trusted only with this secret header
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))
+# Local HTTP server limits: request body size (updates are a few KB) and per-read timeout
+HTTP_MAX_BODY = int(os.getenv("HTTP_MAX_BODY", str(1024 * 1024)))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+# /healthz readiness probe: 503 unless the pool answers SELECT 1 within this many seconds
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "2"))
+
+# Concurrent update processing (see OrderedUpdateProcessor)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_QUEUE_WARN = int(os.getenv("UPDATE_QUEUE_WARN", "100"))
+
+# Local Prometheus-style /metrics endpoint, opt-in: set METRICS_PORT (0 = disabled)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
 # Price plans
 DEFAULT_PLANS = [1, 3, 7, 15, 30, 60]
 DEFAULT_PRICES = {
@@ -54,13 +99,122 @@ ADMIN_ADD_PRODUCT_NAME, ADMIN_ADD_PRODUCT_SHORT = 100, 101
 
 # UPI (defaults to your provided UPI if .env not set)
 UPI_ID = os.getenv("UPI_ID", "ninjagamerop0786@ybl")
+QR_PATH = os.getenv("QR_PATH", "qr.jpg")
+
+# Auto-approval of transaction IDs found in an imported UPI statement ledger
+AUTO_APPROVE = os.getenv("AUTO_APPROVE", "0") == "1"
+LEDGER_DIR = os.getenv("LEDGER_DIR", "")  # watched for statement .csv exports; empty disables
+LEDGER_POLL_SECONDS = float(os.getenv("LEDGER_POLL_SECONDS", "30"))
+
+# DB pool sizing and acquire monitoring
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM", str(DB_POOL_MIN)))  # connections opened + prepared at startup
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))  # seconds, 0 = wait forever
+DB_ACQUIRE_WARN_MS = float(os.getenv("DB_ACQUIRE_WARN_MS", "250"))
+
+# Apply pending schema migrations at startup; with 0 run `python bot.py migrate` separately
+DB_MIGRATE_ON_START = os.getenv("DB_MIGRATE_ON_START", "1") == "1"
+
+# Conversation state and user_data persisted to the DB, written in one batch at most
+# every PERSISTENCE_INTERVAL seconds (0 keeps them in memory only)
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))
+
+# DB pool (asyncpg pool wrapped in MeteredPool)
+db_pool: Optional["MeteredPool"] = None
 
-# DB pool
-db_pool: Optional[asyncpg.Pool] = None
+class ProductCatalog:
+    """Snapshot of the products table (active and inactive rows).
 
-# In-memory products list (full names)
+    Never mutated after construction: a refresh builds a new catalog and swaps
+    the global, so readers always see a consistent short <-> name mapping.
+    """
+    
+    def __init__(self, rows=(), version: int = 0):
+        self.version = version
+        self.products: dict[str, dict] = {
+            r["name"]: {"short_name": r["short_name"], "is_active": r["is_active"]} for r in rows
+        }
+        self.name_by_short: dict[str, str] = {r["short_name"]: r["name"] for r in rows if r["short_name"]}
+        self.active_names: list[str] = sorted(n for n, p in self.products.items() if p["is_active"])
+    
+    def is_active(self, name: str) -> bool:
+        p = self.products.get(name)
+        return bool(p and p["is_active"])
+    
+    def name_for_short(self, short_name: str) -> Optional[str]:
+        name = self.name_by_short.get(short_name)
+        return name if name and self.is_active(name) else None
+    
+    def short_for_name(self, name: str) -> Optional[str]:
+        p = self.products.get(name)
+        return p["short_name"] if p else None
+    
+    def active_shorts(self) -> list[str]:
+        return sorted(s for s, n in self.name_by_short.items() if self.is_active(n))
+
+# In-memory product catalog and active products list (full names)
+CATALOG = ProductCatalog()
 PRODUCTS: list[str] = []
 
+# In-memory stock cache: (product, duration) -> unused key count
+STOCK: dict[tuple[str, int], int] = {}
+STOCK_SYNCED_AT = 0.0
+STOCK_CACHE_TTL = float(os.getenv("STOCK_CACHE_TTL", "0"))  # seconds, 0 = never resync
+_stock_lock = asyncio.Lock()
+
+# Low-stock watcher (job queue): alert ADMIN_IDS when a plan drops to LOW_STOCK_THRESHOLD
+# keys or runs out; "low" re-arms above threshold + hysteresis, "out" above hysteresis
+STOCK_WATCH_INTERVAL = float(os.getenv("STOCK_WATCH_INTERVAL", "300"))  # seconds, 0 disables
+LOW_STOCK_THRESHOLD = int(os.getenv("LOW_STOCK_THRESHOLD", "5"))
+LOW_STOCK_HYSTERESIS = int(os.getenv("LOW_STOCK_HYSTERESIS", "2"))
+STOCK_LEVELS = ("ok", "low", "out")
+_stock_alert_level: dict[tuple[str, int], str] = {}
+
+# Key reservations: payment_proof holds a key for the new order for RESERVATION_TTL
+# seconds; a sweeper job returns expired holds to stock
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL", "1800"))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv("RESERVATION_SWEEP_INTERVAL", "60"))
+_reservation_sweeper: Optional[asyncio.Task] = None
+
+# Pending orders older than ORDER_EXPIRY_HOURS are marked 'expired' by a sweeper job,
+# ORDER_SWEEP_BATCH rows per statement (0 hours disables)
+ORDER_EXPIRY_HOURS = float(os.getenv("ORDER_EXPIRY_HOURS", "48"))
+ORDER_SWEEP_INTERVAL = float(os.getenv("ORDER_SWEEP_INTERVAL", "600"))
+ORDER_SWEEP_BATCH = int(os.getenv("ORDER_SWEEP_BATCH", "200"))
+
+# Telegram file_id cache for local media: path -> (sha256, file_id)
+MEDIA_CACHE: dict[str, tuple[str, str]] = {}
+# path -> (mtime, size, sha256), so unchanged files are never re-hashed
+_file_hashes: dict[str, tuple[float, int, str]] = {}
+
+# Sales export streaming
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+EXPORT_SPOOL_BYTES = int(os.getenv("EXPORT_SPOOL_BYTES", str(4 * 1024 * 1024)))
+
+# Orders per page in the /pending admin view
+PENDING_PAGE_SIZE = int(os.getenv("PENDING_PAGE_SIZE", "5"))
+
+# Upper bound on orders approved by one /approve_batch
+BATCH_APPROVE_MAX = int(os.getenv("BATCH_APPROVE_MAX", "100"))
+
+# Bulk key import/removal batch size (keys per statement)
+KEY_BATCH_SIZE = int(os.getenv("KEY_BATCH_SIZE", "500"))
+
+# Outbound message throttling (Telegram allows roughly 1 message/s per chat and
+# about 30 messages/s per bot; GLOBAL_SEND_RATE 0 disables the bot-wide bucket)
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "8"))
+CHAT_SEND_INTERVAL = float(os.getenv("CHAT_SEND_INTERVAL", "1.0"))
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "25"))  # messages/s
+SEND_RETRY_DEADLINE = float(os.getenv("SEND_RETRY_DEADLINE", "120"))  # give up on RetryAfter past this
+_send_semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+# Per-chat state lives only while a chat has sends in flight (refcounted locks) or
+# sent within the last CHAT_SEND_INTERVAL (timestamps, pruned as the dict grows)
+_chat_locks: dict[int, asyncio.Lock] = {}
+_chat_refs: dict[int, int] = {}
+_chat_last_send: dict[int, float] = {}
+_chat_prune_at = 1024
+
 # Short name validator
 SHORT_RE = re.compile(r"^[a-z0-9_]{3,20}$")
 
@@ -72,24 +226,474 @@ def with_cancel_row(rows: list[list[InlineKeyboardButton]]) -> InlineKeyboardMar
     rows.append([InlineKeyboardButton("🚫 Cancel", callback_data="cancel")])
     return InlineKeyboardMarkup(rows)
 
-async def init_db_pool():
-    global db_pool
-    db_pool = await asyncpg.create_pool(
-        host=DB_HOST, 
-        port=DB_PORT, 
-        user=DB_USER, 
-        password=DB_PASS, 
-        database=DB_NAME,
-        min_size=2, 
-        max_size=10,
-        command_timeout=60,  # Increased timeout
-        max_inactive_connection_lifetime=300.0,  # 5 minutes
-        max_queries=50000  # Recreate connection after 50000 queries
-    )
+# ===== METRICS =====
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS: list = []
+# Name of the handler currently running in this task, used to attribute DB queries
+current_handler: contextvars.ContextVar[str] = contextvars.ContextVar("current_handler", default="none")
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames: tuple = ()):
+        self.name, self.doc, self.labelnames = name, doc, labelnames
+        self.values: dict[tuple, float] = {}
+        METRICS.append(self)
     
-    async with db_pool.acquire() as conn:
-        # keys
-        await conn.execute("""
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+    
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self.values.items()]
+        return lines
+
+class Gauge:
+    """Gauge whose value is read from `fn` at scrape time."""
+    
+    def __init__(self, name: str, doc: str, fn: Callable[[], float]):
+        self.name, self.doc, self.fn = name, doc, fn
+        METRICS.append(self)
+    
+    def render(self) -> list[str]:
+        try:
+            value = float(self.fn())
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.doc, self.labelnames, self.buckets = name, doc, labelnames, buckets
+        # labels -> [per-bucket cumulative counts..., sum, count]
+        self.series: dict[tuple, list] = {}
+        METRICS.append(self)
+    
+    def observe(self, value: float, *labels) -> None:
+        s = self.series.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                s[i] += 1
+        s[-2] += value
+        s[-1] += 1
+    
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for labels, s in self.series.items():
+            for bound, n in zip(self.buckets, s):
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), labels + (bound,))} {n}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), labels + ('+Inf',))} {s[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {s[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {s[-1]}")
+        return lines
+
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Handler latency", ("handler", "status"))
+DB_QUERIES = Counter("bot_db_queries_total", "Database queries issued", ("handler",))
+DB_QUERY_LATENCY = Histogram("bot_db_query_duration_seconds", "Database query latency", ("handler",))
+TELEGRAM_API_LATENCY = Histogram("bot_telegram_api_duration_seconds", "Telegram Bot API call latency", ("method", "status"))
+Gauge("bot_db_pool_size", "Open pool connections", lambda: db_pool.get_size())
+Gauge("bot_db_pool_idle", "Idle pool connections", lambda: db_pool.get_idle_size())
+Gauge("bot_db_pool_max", "Pool max size", lambda: db_pool.get_max_size())
+Gauge("bot_db_pool_waiting", "Callers waiting to acquire a pool connection", lambda: db_pool.waiting)
+DB_ACQUIRE_WAIT = Histogram("bot_db_acquire_wait_seconds", "Time spent waiting for a pool connection", ("handler",))
+DB_ACQUIRE_SLOW = Counter("bot_db_acquire_slow_total", "Pool acquires slower than DB_ACQUIRE_WARN_MS", ("handler",))
+ORDER_SWEEP_ROWS = Histogram(
+    "bot_order_sweep_rows", "Pending orders expired per sweep", buckets=(0, 1, 10, 50, 100, 500, 1000, 5000)
+)
+
+async def metrics_route(headers: dict, body: bytes):
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return 200, "text/plain; version=0.0.4", ("\n".join(lines) + "\n").encode()
+
+class MeteredPool:
+    """asyncpg.Pool wrapper that tracks callers blocked in acquire() and how long
+    they waited, warning when a wait exceeds DB_ACQUIRE_WARN_MS."""
+    
+    def __init__(self, pool: asyncpg.Pool):
+        self._pool = pool
+        self.waiting = 0
+    
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout: Optional[float] = None):
+        if timeout is None and DB_ACQUIRE_TIMEOUT > 0:
+            timeout = DB_ACQUIRE_TIMEOUT
+        handler = current_handler.get()
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            conn = await self._pool.acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error(
+                f"DB pool exhausted: {handler} gave up after {timeout}s "
+                f"(size={self._pool.get_size()}, max={self._pool.get_max_size()}, waiting={self.waiting - 1})"
+            )
+            raise
+        finally:
+            self.waiting -= 1
+            waited = time.perf_counter() - start
+            DB_ACQUIRE_WAIT.observe(waited, handler)
+        if waited * 1000 > DB_ACQUIRE_WARN_MS:
+            DB_ACQUIRE_SLOW.inc(handler)
+            logger.warning(
+                f"Slow DB acquire: {handler} waited {waited * 1000:.0f}ms "
+                f"(size={self._pool.get_size()}, max={self._pool.get_max_size()}, waiting={self.waiting}); "
+                f"consider raising DB_POOL_MAX"
+            )
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+    
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+def _log_query(record) -> None:
+    handler = current_handler.get()
+    DB_QUERIES.inc(handler)
+    DB_QUERY_LATENCY.observe(record.elapsed, handler)
+
+class BotConnection(asyncpg.Connection):
+    """Pool connection class that prepares the STATEMENTS registry up front, so
+    the first request on a fresh connection skips the parse/plan round trip."""
+    
+    async def prepare_statements(self) -> None:
+        for sql in STATEMENTS.values():
+            # Populate asyncpg's per-connection statement cache; unlike
+            # PreparedStatement objects it survives release back to the pool.
+            # _prepare is private API (checked against asyncpg < 0.33): if it is
+            # gone or changed, skip the warm-up and let statements prepare lazily.
+            try:
+                await self._prepare(sql, use_cache=True)
+            except (AttributeError, TypeError) as e:
+                logger.warning(f"Statement warm-up unavailable with asyncpg {asyncpg.__version__}: {e}")
+                return
+    
+    async def run(self, name: str, *args, mode: str = "fetch"):
+        """Execute a registered statement by name; `mode` is fetch, fetchrow, fetchval or execute."""
+        return await getattr(self, mode)(STATEMENTS[name], *args)
+
+# Set once the schema exists; connections opened before that prepare lazily
+SCHEMA_READY = False
+DB_READY = asyncio.Event()  # set once init_db_pool() has a migrated, warm pool
+
+async def setup_connection(conn: BotConnection) -> None:
+    """Pool `init` hook, run once for every new connection."""
+    conn.add_query_logger(_log_query)
+    if SCHEMA_READY:
+        await conn.prepare_statements()
+
+async def warm_db_pool() -> None:
+    """Open DB_POOL_WARM connections concurrently and prepare the statements on each."""
+    async def warm_one():
+        async with db_pool.acquire() as conn:
+            await conn.prepare_statements()
+            # Hold the connection briefly so the others are opened in parallel
+            await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    await asyncio.gather(*(warm_one() for _ in range(min(DB_POOL_WARM, DB_POOL_MAX))))
+    logger.info(f"DB pool warmed: {db_pool.get_size()} connections in {time.perf_counter() - start:.2f}s")
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records Bot API latency per method."""
+    
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        status = "error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_API_LATENCY.observe(time.perf_counter() - start, endpoint, status)
+
+# Seconds from process start until the first handler finished (None until then)
+FIRST_UPDATE_SECONDS: Optional[float] = None
+Gauge("bot_first_update_seconds", "Seconds from process start to the first served update", lambda: FIRST_UPDATE_SECONDS)
+
+def instrument(callback):
+    """Wrap a handler callback with latency timing and DB query attribution."""
+    name = callback.__name__
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        global FIRST_UPDATE_SECONDS
+        token = current_handler.set(name)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = await callback(update, context)
+            status = "ok"
+            return result
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name, status)
+            current_handler.reset(token)
+            if FIRST_UPDATE_SECONDS is None:
+                FIRST_UPDATE_SECONDS = time.perf_counter() - STARTUP_T0
+                logger.info(f"First update served {FIRST_UPDATE_SECONDS:.2f}s after process start ({name})")
+    return wrapper
+
+def instrument_handlers(application: Application) -> None:
+    """Instrument every registered handler, including those nested in conversations."""
+    def walk(handlers):
+        for h in handlers:
+            if isinstance(h, ConversationHandler):
+                walk(h.entry_points)
+                for state_handlers in h.states.values():
+                    walk(state_handlers)
+                walk(h.fallbacks)
+            else:
+                h.callback = instrument(h.callback)
+    for group in application.handlers.values():
+        walk(group)
+
+# Claims the key held for a pending order (or, when its hold was never taken or
+# has been swept, the oldest free key), marks it used, approves the order and
+# records the sale in a single statement. SKIP LOCKED keeps concurrent approvals
+# from ever picking the same free key.
+CLAIM_KEY_SQL = """
+WITH held AS (
+    SELECT id FROM keys WHERE reserved_for=$1 AND is_used=FALSE
+    FOR UPDATE
+),
+claimed AS (
+    UPDATE keys SET is_used=TRUE, reserved_for=NULL, reserved_until=NULL
+    WHERE id = COALESCE((SELECT id FROM held), (
+        SELECT k.id FROM keys k
+        JOIN orders o ON k.product_name=o.product_name AND k.duration_days=o.duration_days
+        WHERE o.id=$1 AND o.status='pending' AND k.is_used=FALSE AND k.reserved_for IS NULL
+        ORDER BY k.added_at
+        LIMIT 1
+        FOR UPDATE OF k SKIP LOCKED
+    ))
+    RETURNING key_value
+),
+approved AS (
+    UPDATE orders
+    SET status='approved', key_assigned=(SELECT key_value FROM claimed), approved_at=now(), approved_by=$2
+    WHERE id=$1 AND status='pending' AND EXISTS (SELECT 1 FROM claimed)
+    RETURNING user_id, username, product_name, duration_days, amount
+),
+sale AS (
+    INSERT INTO sales_history (user_id, username, product_name, duration_days, amount, key_given)
+    SELECT a.user_id, a.username, a.product_name, a.duration_days, a.amount, c.key_value
+    FROM approved a, claimed c
+    RETURNING id
+),
+rollup AS (
+    INSERT INTO sales_daily_rollup (day, product_name, duration_days, units, revenue)
+    SELECT now()::DATE, product_name, duration_days, 1, amount FROM approved
+    ON CONFLICT (day, product_name, duration_days)
+    DO UPDATE SET units = sales_daily_rollup.units + excluded.units, revenue = sales_daily_rollup.revenue + excluded.revenue
+    RETURNING day
+)
+SELECT c.key_value, a.user_id, a.username, a.product_name, a.duration_days, a.amount,
+       EXISTS (SELECT 1 FROM held) AS reserved
+FROM claimed c LEFT JOIN approved a ON TRUE
+"""
+
+# Batch variant of CLAIM_KEY_SQL: lock up to $3 of the oldest pending orders for
+# one plan; orders holding a key get that key, the rest are paired by age with
+# the oldest free keys, and every pair is approved set-wise.
+# Rows of `paired` without a matching `approved` row mean an order changed under us.
+CLAIM_BATCH_SQL = """
+WITH locked_orders AS (
+    SELECT id, created_at FROM orders
+    WHERE status='pending' AND product_name=$1 AND duration_days=$2
+    ORDER BY created_at, id
+    LIMIT $3
+    FOR UPDATE SKIP LOCKED
+),
+held_keys AS (
+    SELECT id, key_value, reserved_for FROM keys
+    WHERE reserved_for IN (SELECT id FROM locked_orders) AND is_used=FALSE
+    FOR UPDATE SKIP LOCKED
+),
+locked_keys AS (
+    SELECT id, key_value, added_at FROM keys
+    WHERE is_used=FALSE AND reserved_for IS NULL AND product_name=$1 AND duration_days=$2
+    ORDER BY added_at, id
+    LIMIT $3
+    FOR UPDATE SKIP LOCKED
+),
+paired AS (
+    SELECT reserved_for AS order_id, id AS key_id, key_value, TRUE AS reserved FROM held_keys
+    UNION ALL
+    SELECT o.id, k.id, k.key_value, FALSE
+    FROM (
+        SELECT id, row_number() OVER (ORDER BY created_at, id) AS rn FROM locked_orders
+        WHERE id NOT IN (SELECT reserved_for FROM held_keys)
+    ) o
+    JOIN (SELECT id, key_value, row_number() OVER (ORDER BY added_at, id) AS rn FROM locked_keys) k
+    ON o.rn = k.rn
+),
+claimed AS (
+    UPDATE keys SET is_used=TRUE, reserved_for=NULL, reserved_until=NULL
+    WHERE id IN (SELECT key_id FROM paired) AND is_used=FALSE
+    RETURNING id
+),
+approved AS (
+    UPDATE orders o
+    SET status='approved', key_assigned=p.key_value, approved_at=now(), approved_by=$4
+    FROM paired p
+    WHERE o.id=p.order_id AND o.status='pending'
+    RETURNING o.id, o.user_id, o.username, o.product_name, o.duration_days, o.amount, o.key_assigned
+),
+sale AS (
+    INSERT INTO sales_history (user_id, username, product_name, duration_days, amount, key_given)
+    SELECT user_id, username, product_name, duration_days, amount, key_assigned
+    FROM approved
+    RETURNING id
+),
+rollup AS (
+    INSERT INTO sales_daily_rollup (day, product_name, duration_days, units, revenue)
+    SELECT now()::DATE, product_name, duration_days, count(*), sum(amount) FROM approved
+    GROUP BY product_name, duration_days
+    ON CONFLICT (day, product_name, duration_days)
+    DO UPDATE SET units = sales_daily_rollup.units + excluded.units, revenue = sales_daily_rollup.revenue + excluded.revenue
+    RETURNING day
+)
+SELECT p.order_id, p.key_value, p.reserved, a.user_id, a.username, a.product_name, a.duration_days, a.amount,
+       (SELECT count(*) FROM claimed) AS claimed
+FROM paired p LEFT JOIN approved a ON a.id = p.order_id
+"""
+
+# Rebuilds sales_daily_rollup rows from sales_history (migration 6 and /stats rebuild)
+ROLLUP_BACKFILL_SQL = """
+INSERT INTO sales_daily_rollup (day, product_name, duration_days, units, revenue)
+SELECT created_at::DATE, product_name, duration_days, count(*), sum(amount)
+FROM sales_history
+GROUP BY created_at::DATE, product_name, duration_days
+ON CONFLICT (day, product_name, duration_days) DO NOTHING
+"""
+
+# Registry of the hot queries, prepared on every pool connection (see
+# BotConnection) and executed by name with conn.run(name, *args)
+STATEMENTS = {
+    "stock_counts": """
+        SELECT product_name, duration_days, COUNT(*) AS cnt
+        FROM keys
+        WHERE is_used=FALSE AND reserved_for IS NULL
+        GROUP BY product_name, duration_days
+    """,
+    "stock_counts_for_product": """
+        SELECT product_name, duration_days, COUNT(*) AS cnt
+        FROM keys
+        WHERE is_used=FALSE AND reserved_for IS NULL AND product_name=$1
+        GROUP BY product_name, duration_days
+    """,
+    # Creates the order and holds the oldest free key for it for $7 seconds, unless
+    # the user already holds one for another pending order (one hold per user)
+    "create_order": """
+        WITH held AS (
+            UPDATE keys SET reserved_for=$1, reserved_until=now() + $7::INT * INTERVAL '1 second'
+            WHERE id = (
+                SELECT id FROM keys
+                WHERE product_name=$4 AND duration_days=$5 AND is_used=FALSE AND reserved_for IS NULL
+                    AND NOT EXISTS (
+                        SELECT 1 FROM orders o JOIN keys k ON k.reserved_for=o.id
+                        WHERE o.user_id=$2 AND o.status='pending' AND k.is_used=FALSE
+                    )
+                ORDER BY added_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id
+        )
+        INSERT INTO orders (id, user_id, username, product_name, duration_days, amount, status)
+        VALUES ($1, $2, $3, $4, $5, $6, 'pending')
+        RETURNING EXISTS (SELECT 1 FROM held) AS reserved
+    """,
+    "claim_key": CLAIM_KEY_SQL,
+    "claim_batch": CLAIM_BATCH_SQL,
+    "reject_order": """
+        WITH rejected AS (
+            UPDATE orders SET status='rejected'
+            WHERE id=$1 AND status='pending'
+            RETURNING user_id, username, product_name, duration_days, amount
+        ),
+        released AS (
+            UPDATE keys SET reserved_for=NULL, reserved_until=NULL
+            WHERE reserved_for=$1 AND is_used=FALSE AND EXISTS (SELECT 1 FROM rejected)
+            RETURNING id
+        )
+        SELECT r.*, (SELECT count(*) FROM released) AS released FROM rejected r
+    """,
+    # One bounded batch of stale pending orders (oldest first, via idx_orders_status_created);
+    # any key still held for them goes back to stock
+    "expire_orders": """
+        WITH expired AS (
+            UPDATE orders SET status='expired'
+            WHERE status='pending' AND id IN (
+                SELECT id FROM orders
+                WHERE status='pending' AND created_at < now() - $1::INT * INTERVAL '1 second'
+                ORDER BY created_at
+                LIMIT $2
+            )
+            RETURNING id, user_id, product_name, duration_days
+        ),
+        released AS (
+            UPDATE keys SET reserved_for=NULL, reserved_until=NULL
+            WHERE reserved_for IN (SELECT id FROM expired) AND is_used=FALSE
+            RETURNING reserved_for
+        )
+        SELECT e.id, e.user_id, e.product_name, e.duration_days,
+               EXISTS (SELECT 1 FROM released r WHERE r.reserved_for = e.id) AS released
+        FROM expired e
+    """,
+    # Today / last 7 days / last $1 days per plan, read from the rollup's primary key
+    "sales_stats": """
+        SELECT product_name, duration_days,
+               SUM(CASE WHEN day = current_date THEN units ELSE 0 END) AS units_today,
+               SUM(CASE WHEN day = current_date THEN revenue ELSE 0 END) AS revenue_today,
+               SUM(CASE WHEN day > current_date - 7 THEN units ELSE 0 END) AS units_week,
+               SUM(CASE WHEN day > current_date - 7 THEN revenue ELSE 0 END) AS revenue_week,
+               SUM(units) AS units, SUM(revenue) AS revenue
+        FROM sales_daily_rollup
+        WHERE day > current_date - $1::INT
+        GROUP BY product_name, duration_days
+        ORDER BY product_name, duration_days
+    """,
+    "release_expired_holds": """
+        UPDATE keys SET reserved_for=NULL, reserved_until=NULL
+        WHERE reserved_until < now() AND is_used=FALSE
+        RETURNING product_name, duration_days
+    """,
+    # Primary-key lookup; a ledger entry pays for at most one order
+    "claim_ledger_entry": """
+        UPDATE payment_ledger SET order_id=$2, claimed_at=now()
+        WHERE txn_id=$1 AND order_id IS NULL AND amount=$3
+        RETURNING txn_id
+    """,
+    "order_status": "SELECT status, user_id, product_name, duration_days FROM orders WHERE id=$1",
+    # Keyset pages over idx_orders_status_created; (created_at, id) is the cursor
+    "pending_after": """
+        SELECT id, user_id, username, product_name, duration_days, amount, created_at
+        FROM orders
+        WHERE status='pending' AND (created_at, id) > ($1, $2)
+        ORDER BY created_at, id
+        LIMIT $3
+    """,
+    "pending_before": """
+        SELECT id, user_id, username, product_name, duration_days, amount, created_at
+        FROM orders
+        WHERE status='pending' AND (created_at, id) < ($1, $2)
+        ORDER BY created_at DESC, id DESC
+        LIMIT $3
+    """,
+}
+
+# ===== SCHEMA MIGRATIONS =====
+# (version, description, statements). Append only; never edit an applied migration.
+# Statements run one at a time outside a transaction (CockroachDB schema changes).
+MIGRATIONS = [
+    (1, "base schema", [
+        """
         CREATE TABLE IF NOT EXISTS keys (
             id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
             duration_days INT NOT NULL,
@@ -98,12 +702,10 @@ async def init_db_pool():
             added_at TIMESTAMP DEFAULT now(),
             product_name STRING NOT NULL DEFAULT 'bgmi loader'
         )
-        """)
-        await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_keys_key_value_unique ON keys (key_value)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_keys_lookup ON keys (product_name, duration_days, is_used)")
-        
-        # orders
-        await conn.execute("""
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_keys_key_value_unique ON keys (key_value)",
+        "CREATE INDEX IF NOT EXISTS idx_keys_lookup ON keys (product_name, duration_days, is_used)",
+        """
         CREATE TABLE IF NOT EXISTS orders (
             id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
             user_id STRING NOT NULL,
@@ -117,11 +719,9 @@ async def init_db_pool():
             product_name STRING NOT NULL DEFAULT 'bgmi loader',
             approved_by STRING
         )
-        """)
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at)")
-        
-        # sales_history
-        await conn.execute("""
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at)",
+        """
         CREATE TABLE IF NOT EXISTS sales_history (
             id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
             user_id STRING NOT NULL,
@@ -132,52 +732,711 @@ async def init_db_pool():
             created_at TIMESTAMP DEFAULT now(),
             product_name STRING NOT NULL DEFAULT 'bgmi loader'
         )
-        """)
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_sales_created ON sales_history (created_at)")
-        
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_sales_created ON sales_history (created_at)",
         # products (no default seed)
-        await conn.execute("""
+        """
         CREATE TABLE IF NOT EXISTS products (
             name STRING PRIMARY KEY,
             short_name STRING UNIQUE,
             is_active BOOL DEFAULT TRUE,
             created_at TIMESTAMP DEFAULT now()
         )
-        """)
-        logger.info("Products table ready (no default seeding)")
-        logger.info("Database initialized")
+        """,
+    ]),
+    (2, "media_cache", [
+        # Telegram file_ids of uploaded local files
+        """
+        CREATE TABLE IF NOT EXISTS media_cache (
+            name STRING PRIMARY KEY,
+            file_hash STRING NOT NULL,
+            file_id STRING NOT NULL,
+            updated_at TIMESTAMP DEFAULT now()
+        )
+        """,
+    ]),
+    (3, "payment_ledger", [
+        # Credits from UPI statement exports; txn_id is the normalized UTR / reference
+        """
+        CREATE TABLE IF NOT EXISTS payment_ledger (
+            txn_id STRING PRIMARY KEY,
+            amount DECIMAL NOT NULL,
+            payer STRING,
+            imported_at TIMESTAMP DEFAULT now(),
+            order_id UUID,
+            claimed_at TIMESTAMP
+        )
+        """,
+    ]),
+    (4, "persistence", [
+        # PostgresPersistence: user_data as JSON, ConversationHandler states by (name, key)
+        """
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id INT8 PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP DEFAULT now()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name STRING NOT NULL,
+            key STRING NOT NULL,
+            state INT NOT NULL,
+            updated_at TIMESTAMP DEFAULT now(),
+            PRIMARY KEY (name, key)
+        )
+        """,
+    ]),
+    (5, "key reservations", [
+        # A key held for a pending order is neither in stock nor claimable by other orders
+        "ALTER TABLE keys ADD COLUMN IF NOT EXISTS reserved_for UUID",
+        "ALTER TABLE keys ADD COLUMN IF NOT EXISTS reserved_until TIMESTAMP",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_keys_reserved_for ON keys (reserved_for) WHERE reserved_for IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_keys_reserved_until ON keys (reserved_until) WHERE reserved_until IS NOT NULL",
+    ]),
+    (6, "sales_daily_rollup", [
+        # Units and revenue per (day, plan); maintained by the claim statements
+        """
+        CREATE TABLE IF NOT EXISTS sales_daily_rollup (
+            day DATE NOT NULL,
+            product_name STRING NOT NULL,
+            duration_days INT NOT NULL,
+            units INT NOT NULL DEFAULT 0,
+            revenue DECIMAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_name, duration_days)
+        )
+        """,
+        ROLLUP_BACKFILL_SQL,
+    ]),
+    (7, "orders by user", [
+        # create_order's one-hold-per-user check
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_status ON orders (user_id, status)",
+    ]),
+]
+
+async def get_schema_version(conn) -> int:
+    try:
+        return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except asyncpg.exceptions.UndefinedTableError:
+        return 0
+
+async def run_migrations(conn) -> int:
+    """Apply pending MIGRATIONS in order. When the schema is current this is a
+    single SELECT and no DDL runs at all."""
+    current = await get_schema_version(conn)
+    pending = [m for m in MIGRATIONS if m[0] > current]
+    if not pending:
+        logger.info(f"Schema is current (v{current})")
+        return current
+    
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            description STRING,
+            applied_at TIMESTAMP DEFAULT now()
+        )
+    """)
+    for version, description, statements in pending:
+        start = time.perf_counter()
+        for stmt in statements:
+            await conn.execute(stmt)
+        # ON CONFLICT: another instance may have applied it during a rolling restart
+        await conn.execute(
+            "INSERT INTO schema_version (version, description) VALUES ($1, $2) ON CONFLICT (version) DO NOTHING",
+            version, description
+        )
+        logger.info(f"Applied migration {version} ({description}) in {time.perf_counter() - start:.2f}s")
+    return pending[-1][0]
+
+async def init_db_pool():
+    global db_pool, SCHEMA_READY
+    db_pool = MeteredPool(await asyncpg.create_pool(
+        host=DB_HOST, 
+        port=DB_PORT, 
+        user=DB_USER, 
+        password=DB_PASS, 
+        database=DB_NAME,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        command_timeout=60,  # Increased timeout
+        max_inactive_connection_lifetime=300.0,  # 5 minutes
+        max_queries=50000,  # Recreate connection after 50000 queries
+        init=setup_connection,
+        connection_class=BotConnection,
+    ))
+    
+    async with db_pool.acquire() as conn:
+        if DB_MIGRATE_ON_START:
+            await run_migrations(conn)
+        else:
+            current = await get_schema_version(conn)
+            if current < MIGRATIONS[-1][0]:
+                raise RuntimeError(f"Schema is at v{current}, expected v{MIGRATIONS[-1][0]}; run `python bot.py migrate`")
+    
+    logger.info("Database initialized")
+    
+    SCHEMA_READY = True
+    await warm_db_pool()
+    DB_READY.set()
 
 async def load_products_from_db():
-    global PRODUCTS
+    """(Re)load the product catalog. Called at startup and by the handlers that
+    write to the products table; read paths only ever use the snapshot."""
+    global CATALOG, PRODUCTS
     async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT name FROM products WHERE is_active=TRUE ORDER BY name")
-        PRODUCTS = [r["name"] for r in rows] or []
-    logger.info(f"Loaded products: {PRODUCTS}")
+        rows = await conn.fetch("SELECT name, short_name, is_active FROM products ORDER BY name")
+    CATALOG = ProductCatalog(rows, version=CATALOG.version + 1)
+    PRODUCTS = CATALOG.active_names
+    logger.info(f"Loaded products (catalog v{CATALOG.version}): {PRODUCTS}")
 
-async def get_available_product_shorts() -> list[str]:
+async def load_media_cache():
+    global MEDIA_CACHE
     async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT short_name FROM products
-            WHERE is_active=TRUE AND short_name IS NOT NULL
-            ORDER BY short_name
-        """)
-        return [r["short_name"] for r in rows]
+        rows = await conn.fetch("SELECT name, file_hash, file_id FROM media_cache")
+    MEDIA_CACHE = {r["name"]: (r["file_hash"], r["file_id"]) for r in rows}
+    logger.info(f"Loaded media cache: {list(MEDIA_CACHE)}")
+
+def file_sha256(path: str) -> str:
+    st = os.stat(path)
+    cached = _file_hashes.get(path)
+    if cached and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _file_hashes[path] = (st.st_mtime, st.st_size, digest)
+    return digest
+
+async def send_cached_photo(bot, chat_id: int, path: str, **kwargs):
+    """Send a local photo by its Telegram file_id, uploading only when it is new or changed."""
+    digest = file_sha256(path)
+    cached = MEDIA_CACHE.get(path)
+    if cached and cached[0] == digest:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=cached[1], **kwargs)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id for {path} rejected, re-uploading: {e}")
+    
+    with open(path, "rb") as f:
+        msg = await bot.send_photo(chat_id=chat_id, photo=InputFile(f), **kwargs)
+    file_id = msg.photo[-1].file_id
+    MEDIA_CACHE[path] = (digest, file_id)
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO media_cache (name, file_hash, file_id, updated_at)
+                VALUES ($1, $2, $3, now())
+                ON CONFLICT (name) DO UPDATE
+                SET file_hash=excluded.file_hash, file_id=excluded.file_id, updated_at=now()
+            """, path, digest, file_id)
+    except Exception as e:
+        logger.error(f"Error saving media cache for {path}: {e}")
+    return msg
+
+def get_available_product_shorts() -> list[str]:
+    return CATALOG.active_shorts()
 
-async def get_full_name_by_short(short_name: str) -> Optional[str]:
+def get_full_name_by_short(short_name: str) -> Optional[str]:
+    return CATALOG.name_for_short(short_name)
+
+async def fetch_stock_counts(product: Optional[str] = None) -> dict[tuple[str, int], int]:
+    """Unused-key counts for every duration of one product (or of every product)
+    in a single GROUP BY on a single connection."""
     async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT name FROM products
-            WHERE short_name=$1 AND is_active=TRUE
-        """, short_name)
-        return row["name"] if row else None
+        if product is None:
+            rows = await conn.run("stock_counts")
+        else:
+            rows = await conn.run("stock_counts_for_product", product)
+    return {(r["product_name"], r["duration_days"]): int(r["cnt"]) for r in rows}
+
+async def refresh_stock_cache():
+    """Reload every (product, duration) unused-key count in one grouped query."""
+    global STOCK, STOCK_SYNCED_AT
+    STOCK = await fetch_stock_counts()
+    STOCK_SYNCED_AT = time.monotonic()
+    logger.info(f"Stock cache loaded: {len(STOCK)} plans")
+
+def adjust_stock(product: str, duration: int, delta: int) -> None:
+    """Write-through update of the stock cache after a key is added/removed/used."""
+    k = (product, duration)
+    STOCK[k] = max(0, STOCK.get(k, 0) + delta)
+
+async def get_stock_counts(product: Optional[str] = None, fresh: bool = False) -> dict[tuple[str, int], int]:
+    """Shared stock API: {(product, duration): count} for one product or all products.
+
+    Served from the in-memory cache; `fresh=True` (or an expired STOCK_CACHE_TTL)
+    resyncs the cache from the database first.
+    """
+    stale = STOCK_CACHE_TTL > 0 and time.monotonic() - STOCK_SYNCED_AT > STOCK_CACHE_TTL
+    if stale or (fresh and product is None):
+        async with _stock_lock:
+            # Another caller may have resynced while we waited
+            if fresh or time.monotonic() - STOCK_SYNCED_AT > STOCK_CACHE_TTL:
+                await refresh_stock_cache()
+    elif fresh:
+        counts = await fetch_stock_counts(product)
+        for d in DEFAULT_PLANS:
+            STOCK[(product, d)] = counts.get((product, d), 0)
+    if product is None:
+        return dict(STOCK)
+    return {(product, d): STOCK.get((product, d), 0) for d in DEFAULT_PLANS}
 
 async def get_available_keys_count(product: str, duration: int) -> int:
+    counts = await get_stock_counts(product)
+    return counts.get((product, duration), 0)
+
+def stock_level(count: int, previous: str) -> str:
+    if count == 0:
+        return "out"
+    if previous == "out" and count <= LOW_STOCK_HYSTERESIS:
+        return "out"  # a key or two trickling back in doesn't re-arm the alert
+    if count <= LOW_STOCK_THRESHOLD:
+        return "low"
+    if previous != "ok" and count <= LOW_STOCK_THRESHOLD + LOW_STOCK_HYSTERESIS:
+        return "low"  # not re-armed yet
+    return "ok"
+
+async def stock_watch_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Resync the stock cache with one grouped query and alert the admins about
+    every plan that got worse (ok -> low -> out) since the last alert."""
+    async with _stock_lock:
+        await refresh_stock_cache()
+    
+    alerts = []
+    for product in PRODUCTS:
+        for days in DEFAULT_PLANS:
+            k = (product, days)
+            count = STOCK.get(k, 0)
+            previous = _stock_alert_level.get(k, "ok")
+            level = stock_level(count, previous)
+            _stock_alert_level[k] = level
+            if STOCK_LEVELS.index(level) > STOCK_LEVELS.index(previous):
+                icon = "❌ Out of stock" if level == "out" else f"⚠️ Low stock ({count} left)"
+                alerts.append(f"{icon}: {product.title()} - {days} Days")
+    
+    if alerts:
+        text = "📦 Stock alert\n\n" + "\n".join(alerts) + "\n\nAdd keys with /add_keys."
+        sends = [(admin_id, functools.partial(context.bot.send_message, chat_id=admin_id, text=text)) for admin_id in ADMIN_IDS]
+        await fan_out(sends, "stock alert")
+
+async def reservation_sweeper() -> None:
+    """Every RESERVATION_SWEEP_INTERVAL seconds, return keys whose hold expired
+    (order still unapproved) to stock; such an order can still be approved and
+    then claims any free key. A plain task rather than a job-queue job, so holds
+    are released even without the job-queue extra."""
+    while True:
+        try:
+            async with db_pool.acquire() as conn:
+                rows = await conn.run("release_expired_holds")
+            for r in rows:
+                adjust_stock(r["product_name"], r["duration_days"], +1)
+            if rows:
+                logger.info(f"Released {len(rows)} expired key reservation(s)")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Reservation sweep failed")
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL)
+
+async def order_sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Expire stale pending orders in ORDER_SWEEP_BATCH-sized statements and tell
+    each buyer through the throttled sender before taking the next batch."""
+    current_handler.set("order_sweep")
+    touched = 0
+    while True:
+        async with db_pool.acquire() as conn:
+            rows = await conn.run("expire_orders", int(ORDER_EXPIRY_HOURS * 3600), ORDER_SWEEP_BATCH)
+        touched += len(rows)
+        for r in rows:
+            if r["released"]:
+                adjust_stock(r["product_name"], r["duration_days"], +1)
+        sends = [
+            (int(r["user_id"]), functools.partial(
+                context.bot.send_message, chat_id=int(r["user_id"]),
+                text=(
+                    f"⌛ Your order for {r['product_name'].title()} - {r['duration_days']} Days "
+                    f"expired without verification.\n\n"
+                    f"If you already paid, please contact support with your transaction ID."
+                )
+            ))
+            for r in rows
+        ]
+        if sends:
+            await fan_out(sends, "order expiry")
+        if len(rows) < ORDER_SWEEP_BATCH:
+            break
+    ORDER_SWEEP_ROWS.observe(touched)
+    if touched:
+        logger.info(f"Expired {touched} stale pending order(s)")
+
+# ===== PERSISTENCE =====
+class PostgresPersistence(BasePersistence):
+    """Keeps ConversationHandler states and user_data in the database.
+
+    PTB hands over changed entries every `update_interval` seconds; they are
+    buffered here and written a moment later as one transaction of set-wise
+    upserts/deletes, so handlers never wait on a persistence write. Everything
+    is loaded once at startup (refresh_* are no-ops), so several processes may
+    share the tables only if each user is always routed to the same process.
+    """
+    
+    write_delay = 1.0  # seconds to collect the entries of one update_persistence() pass
+    
+    def __init__(self, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._conversations: Optional[dict[str, dict]] = None
+        # Pending writes; None means delete
+        self._dirty_users: dict[int, Optional[str]] = {}
+        self._dirty_conversations: dict[tuple[str, str], Optional[int]] = {}
+        self._write_task: Optional[asyncio.Task] = None
+    
+    async def get_user_data(self) -> dict[int, dict]:
+        await DB_READY.wait()
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch("SELECT user_id, data::STRING AS data FROM bot_user_data")
+        return {r["user_id"]: json.loads(r["data"]) for r in rows}
+    
+    async def get_conversations(self, name: str) -> dict:
+        if self._conversations is None:
+            await DB_READY.wait()
+            async with db_pool.acquire() as conn:
+                rows = await conn.fetch("SELECT name, key, state FROM bot_conversations")
+            self._conversations = {}
+            for r in rows:
+                self._conversations.setdefault(r["name"], {})[tuple(json.loads(r["key"]))] = r["state"]
+        return self._conversations.pop(name, {})
+    
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._dirty_users[user_id] = json.dumps(data) if data else None
+        self._schedule_write()
+    
+    async def drop_user_data(self, user_id: int) -> None:
+        self._dirty_users[user_id] = None
+        self._schedule_write()
+    
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
+    
+    def _schedule_write(self) -> None:
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_later())
+    
+    async def _write_later(self) -> None:
+        await asyncio.sleep(self.write_delay)
+        await self._write()
+    
+    async def _write(self) -> None:
+        users, self._dirty_users = self._dirty_users, {}
+        convs, self._dirty_conversations = self._dirty_conversations, {}
+        if not users and not convs:
+            return
+        upsert_users = [(u, d) for u, d in users.items() if d is not None]
+        drop_users = [u for u, d in users.items() if d is None]
+        upsert_convs = [(n, k, s) for (n, k), s in convs.items() if s is not None]
+        drop_convs = [(n, k) for (n, k), s in convs.items() if s is None]
+        try:
+            async with db_pool.acquire() as conn, conn.transaction():
+                if upsert_users:
+                    await conn.execute("""
+                        INSERT INTO bot_user_data (user_id, data)
+                        SELECT u, d::JSONB FROM unnest($1::INT8[], $2::STRING[]) AS t(u, d)
+                        ON CONFLICT (user_id) DO UPDATE SET data=excluded.data, updated_at=now()
+                    """, *map(list, zip(*upsert_users)))
+                if drop_users:
+                    await conn.execute("DELETE FROM bot_user_data WHERE user_id = ANY($1::INT8[])", drop_users)
+                if upsert_convs:
+                    await conn.execute("""
+                        INSERT INTO bot_conversations (name, key, state)
+                        SELECT * FROM unnest($1::STRING[], $2::STRING[], $3::INT[])
+                        ON CONFLICT (name, key) DO UPDATE SET state=excluded.state, updated_at=now()
+                    """, *map(list, zip(*upsert_convs)))
+                if drop_convs:
+                    await conn.execute("""
+                        DELETE FROM bot_conversations
+                        WHERE (name, key) IN (SELECT * FROM unnest($1::STRING[], $2::STRING[]))
+                    """, *map(list, zip(*drop_convs)))
+        except Exception:
+            # Keep the entries for the next pass unless a newer value arrived meanwhile
+            self._dirty_users = {**users, **self._dirty_users}
+            self._dirty_conversations = {**convs, **self._dirty_conversations}
+            logger.exception("Persistence write failed")
+            return
+        logger.debug(f"Persisted {len(users)} user_data and {len(convs)} conversation entries")
+    
+    async def flush(self) -> None:
+        if self._write_task is not None:
+            await self._write_task
+        await self._write()
+    
+    # Stored elsewhere or not at all (see store_data)
+    async def get_bot_data(self) -> dict:
+        return {}
+    
+    async def update_bot_data(self, data) -> None:
+        pass
+    
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+    
+    async def get_chat_data(self) -> dict:
+        return {}
+    
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+    
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+    
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        pass
+    
+    async def get_callback_data(self) -> None:
+        return None
+    
+    async def update_callback_data(self, data) -> None:
+        pass
+
+# ===== OUTBOUND MESSAGING =====
+class TokenBucket:
+    """Bot-wide send budget: `rate` tokens per second with no burst, so any one
+    second sees at most about `rate` sends. pause() stops all sends, e.g. while
+    Telegram's RetryAfter is in effect."""
+    
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self) -> None:
+        async with self._lock:  # waiters are served in arrival order
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.rate <= 0:
+                    return
+                self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_send_bucket = TokenBucket(GLOBAL_SEND_RATE)
+
+async def send_throttled(chat_id: int, send: Callable[[], Awaitable]):
+    """Await `send()` (a message call to chat_id) under the bot-wide rate limit, the
+    global concurrency bound and the per-chat rate limit. RetryAfter pauses every
+    send and is retried until SEND_RETRY_DEADLINE; the semaphore is not held while
+    waiting."""
+    lock = _chat_locks.setdefault(chat_id, asyncio.Lock())
+    _chat_refs[chat_id] = _chat_refs.get(chat_id, 0) + 1
+    try:
+        async with lock:
+            wait = _chat_last_send.get(chat_id, 0.0) + CHAT_SEND_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            deadline = time.monotonic() + SEND_RETRY_DEADLINE
+            while True:
+                await _send_bucket.acquire()
+                try:
+                    async with _send_semaphore:
+                        return await send()
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta):
+                        delay = delay.total_seconds()
+                    if time.monotonic() + delay > deadline:
+                        raise
+                    logger.warning(f"Rate limited sending to {chat_id}, retrying in {delay}s")
+                    _send_bucket.pause(delay)
+                    await asyncio.sleep(delay)
+                finally:
+                    _chat_last_send[chat_id] = time.monotonic()
+    finally:
+        _chat_refs[chat_id] -= 1
+        if not _chat_refs[chat_id]:
+            del _chat_refs[chat_id]
+            del _chat_locks[chat_id]
+            _prune_chat_last_send()
+
+def _prune_chat_last_send() -> None:
+    """Forget send times too old to delay anything; runs each time the dict doubles."""
+    global _chat_prune_at
+    if len(_chat_last_send) < _chat_prune_at:
+        return
+    cutoff = time.monotonic() - CHAT_SEND_INTERVAL
+    for chat_id in [c for c, t in _chat_last_send.items() if t <= cutoff and c not in _chat_locks]:
+        del _chat_last_send[chat_id]
+    _chat_prune_at = max(1024, 2 * len(_chat_last_send))
+
+async def fan_out(sends: list[tuple[int, Callable[[], Awaitable]]], label: str) -> list[bool]:
+    """Deliver to many chats concurrently; `sends` is a list of (chat_id, zero-arg
+    coroutine factory) pairs and a chat may appear more than once. Returns whether
+    each send was delivered, in input order, and logs the outcome per send."""
+    results = await asyncio.gather(
+        *(send_throttled(chat_id, send) for chat_id, send in sends),
+        return_exceptions=True
+    )
+    delivered = []
+    for (chat_id, _), res in zip(sends, results):
+        if isinstance(res, Exception):
+            logger.error(f"{label}: delivery to {chat_id} failed: {res}")
+        else:
+            logger.info(f"{label}: delivered to {chat_id}")
+        delivered.append(not isinstance(res, Exception))
+    return delivered
+
+# ===== PAYMENT LEDGER (auto-approval) =====
+LEDGER_TXN_HEADERS = ("utr", "transaction id", "txn id", "upi ref", "reference", "ref no")
+LEDGER_AMOUNT_HEADERS = ("credit", "amount")
+LEDGER_PAYER_HEADERS = ("payer", "name", "from", "description", "narration")
+_ledger_watcher: Optional[asyncio.Task] = None
+
+LEDGER_AMOUNT_RE = re.compile(r"[+-]?\d+(\.\d+)?")
+
+def normalize_txn_id(value: str) -> str:
+    return re.sub(r"\s+", "", value or "").upper()
+
+def parse_ledger_amount(value: str) -> Optional[Decimal]:
+    """Signed amount of a statement cell such as "₹1,499.00", "-499", "499.00 Dr"
+    or "(499.00)"; debits come back negative, unparsable cells as None."""
+    text = re.sub(r"INR|RS\.?|₹|,|\s", "", (value or "").upper())
+    debit = False
+    if text.endswith(("CR", "DR")):
+        debit, text = text.endswith("DR"), text[:-2]
+    if text.startswith("(") and text.endswith(")"):
+        debit, text = True, text[1:-1]
+    if not LEDGER_AMOUNT_RE.fullmatch(text):
+        return None
+    amount = Decimal(text)
+    return -abs(amount) if debit else amount
+
+def parse_ledger_csv(raw: str) -> list[tuple[str, Decimal, Optional[str]]]:
+    """Extract (txn_id, amount, payer) credits from a UPI statement export.
+
+    The header row is the first one naming both a transaction reference and an
+    amount column (banks put a preamble above it); debit rows are skipped.
+    """
+    import csv
+
+    def find(header: list[str], names: tuple) -> Optional[int]:
+        for name in names:
+            for i, h in enumerate(header):
+                if name in h:
+                    return i
+        return None
+
+    reader = csv.reader(raw.splitlines())
+    for header in reader:
+        header = [h.strip().lower() for h in header]
+        txn_col, amount_col = find(header, LEDGER_TXN_HEADERS), find(header, LEDGER_AMOUNT_HEADERS)
+        if txn_col is not None and amount_col is not None:
+            break
+    else:
+        return []
+    payer_col = find(header, LEDGER_PAYER_HEADERS)
+    type_col = next((i for i, h in enumerate(header) if h in ("type", "dr/cr", "cr/dr")), None)
+
+    entries = {}
+    for row in reader:
+        if len(row) <= max(txn_col, amount_col):
+            continue
+        if type_col is not None and len(row) > type_col and row[type_col].strip().upper().startswith("D"):
+            continue
+        txn_id = normalize_txn_id(row[txn_col])
+        amount = parse_ledger_amount(row[amount_col])
+        if txn_id and amount is not None and amount > 0:
+            payer = row[payer_col].strip() if payer_col is not None and len(row) > payer_col else None
+            entries[txn_id] = (txn_id, amount, payer or None)
+    return list(entries.values())
+
+async def import_ledger(entries: list[tuple[str, Decimal, Optional[str]]]) -> int:
+    """Insert ledger entries in KEY_BATCH_SIZE batches; already imported txn_ids are kept as is.
+    Returns the number of new entries."""
+    inserted = 0
     async with db_pool.acquire() as conn:
-        count = await conn.fetchval("""
-            SELECT COUNT(*) FROM keys
-            WHERE duration_days=$1 AND product_name=$2 AND is_used=FALSE
-        """, duration, product)
-        return int(count or 0)
+        for i in range(0, len(entries), KEY_BATCH_SIZE):
+            txn_ids, amounts, payers = zip(*entries[i:i + KEY_BATCH_SIZE])
+            rows = await conn.fetch("""
+                INSERT INTO payment_ledger (txn_id, amount, payer)
+                SELECT * FROM unnest($1::STRING[], $2::DECIMAL[], $3::STRING[])
+                ON CONFLICT (txn_id) DO NOTHING
+                RETURNING txn_id
+            """, list(txn_ids), list(amounts), list(payers))
+            inserted += len(rows)
+    return inserted
+
+async def watch_ledger_dir() -> None:
+    """Import every .csv dropped into LEDGER_DIR, renaming it to *.imported once done.
+
+    A file is only read once its size and mtime are unchanged between two polls,
+    so an export that is still being written is never imported partially.
+    """
+    seen: dict[str, tuple[int, float]] = {}
+    while True:
+        try:
+            current = {}
+            for name in sorted(os.listdir(LEDGER_DIR)):
+                if not name.lower().endswith(".csv"):
+                    continue
+                path = os.path.join(LEDGER_DIR, name)
+                st = os.stat(path)
+                current[name] = (st.st_size, st.st_mtime)
+                if seen.get(name) != current[name]:
+                    continue  # new or still growing; look again next poll
+                with open(path, encoding="utf-8-sig", errors="replace") as f:
+                    entries = parse_ledger_csv(f.read())
+                inserted = await import_ledger(entries)
+                os.replace(path, path + ".imported")
+                del current[name]
+                logger.info(f"Ledger {name}: {len(entries)} credits, {inserted} new")
+            seen = current
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Ledger import failed")
+        await asyncio.sleep(LEDGER_POLL_SECONDS)
+
+async def import_ledger_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⚠️ You are not authorized to use this command.")
+        return
+
+    msg = update.message
+    if not msg.document:
+        await msg.reply_text("Usage: send a UPI statement .csv export with /import_ledger as the caption.")
+        return
+
+    try:
+        tg_file = await msg.document.get_file()
+        raw = bytes(await tg_file.download_as_bytearray()).decode("utf-8-sig", errors="replace")
+        entries = parse_ledger_csv(raw)
+        if not entries:
+            await msg.reply_text("⚠️ No credit rows found. The file needs a transaction ID/UTR and an amount column.")
+            return
+        inserted = await import_ledger(entries)
+        await msg.reply_text(
+            f"✅ Ledger import:\n\n"
+            f"Credits in file: {len(entries)}\n"
+            f"New: {inserted}\n"
+            f"Already imported: {len(entries) - inserted}"
+        )
+    except Exception:
+        logger.exception("Error importing ledger")
+        await msg.reply_text("⚠️ An error occurred while importing the ledger.")
 
 # ===== USER FLOW =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -201,14 +1460,12 @@ async def product_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     product = q.data.split("_", 1)[1]
     context.user_data["selected_product"] = product
     
-    tasks = [asyncio.create_task(get_available_keys_count(product, d)) for d in DEFAULT_PLANS]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    counts = {d: (0 if isinstance(c, Exception) else c) for d, c in zip(DEFAULT_PLANS, results)}
+    counts = await get_stock_counts(product)
     
     kb = []
     for i, days in enumerate(DEFAULT_PLANS, 1):
         price = DEFAULT_PRICES[days]
-        count = counts[days]
+        count = counts.get((product, days), 0)
         status = "✅ Available" if count > 0 else "❌ Out of Stock"
         cb = f"plan_{days}" if count > 0 else "no_stock"
         kb.append([InlineKeyboardButton(f"{i}️⃣ {days} Days - ₹{price} ({count} left) {status}", callback_data=cb)])
@@ -256,13 +1513,13 @@ async def plan_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         pass
     
     try:
-        with open("qr.jpg", "rb") as f:
-            await context.bot.send_photo(
-                chat_id=q.message.chat_id,
-                photo=InputFile(f),
-                caption=caption_text,
-                reply_markup=cancel_keyboard()
-            )
+        await send_cached_photo(
+            context.bot,
+            q.message.chat_id,
+            QR_PATH,
+            caption=caption_text,
+            reply_markup=cancel_keyboard()
+        )
     except Exception as e:
         logger.error(f"Error sending QR code: {e}")
         await context.bot.send_message(
@@ -291,71 +1548,130 @@ async def payment_proof(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         return ConversationHandler.END
     
     order_id = str(uuid.uuid4())
+    matched = approved = None
     async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO orders (id, user_id, username, product_name, duration_days, amount, status)
-            VALUES ($1, $2, $3, $4, $5, $6, 'pending')
-        """, order_id, user_id, username, product, duration, price)
+        reserved = await conn.run(
+            "create_order", order_id, user_id, username, product, duration, price, RESERVATION_TTL, mode="fetchval"
+        )
+        if AUTO_APPROVE and update.message.text:
+            txn_id = normalize_txn_id(update.message.text)
+            try:
+                async with conn.transaction():
+                    matched = await conn.run("claim_ledger_entry", txn_id, order_id, price, mode="fetchval")
+                    if matched:
+                        # Paid per the ledger: same claim path as a manual Approve
+                        approved = await claim_key_for_order(conn, order_id, "auto")
+            except Exception:
+                # Rolled back: the ledger entry stays free and the order goes to manual review
+                logger.exception(f"Auto-approval failed for order {order_id}")
+                matched = approved = None
+    
+    if reserved:
+        adjust_stock(product, duration, -1)
+    if approved:
+        if not approved["reserved"]:
+            adjust_stock(product, duration, -1)
+        await update.message.reply_text(key_delivery_text(approved, approved["key_value"]))
+        text = (
+            f"🤖 Order Auto-Approved\n\n"
+            f"User: @{username} (id: {user_id})\n"
+            f"Product: {product.title()}\n"
+            f"Plan: {duration} Days\n"
+            f"Amount: ₹{price}\n"
+            f"Transaction ID: {matched}\n"
+            f"Key Assigned: {approved['key_value']}\n"
+            f"Order ID: {order_id}"
+        )
+        sends = [(admin_id, functools.partial(context.bot.send_message, chat_id=admin_id, text=text)) for admin_id in ADMIN_IDS]
+        context.application.create_task(fan_out(sends, f"auto-approved order {order_id}"), update=update)
+        context.user_data.clear()
+        return ConversationHandler.END
     
     admin_kb = InlineKeyboardMarkup([[
         InlineKeyboardButton("✅ Approve", callback_data=f"approve_{order_id}"),
         InlineKeyboardButton("❌ Reject", callback_data=f"reject_{order_id}"),
     ]])
     
-    for admin_id in ADMIN_IDS:
-        try:
-            if update.message.photo:
-                await context.bot.send_photo(
-                    chat_id=admin_id,
-                    photo=update.message.photo[-1].file_id,
-                    caption=(
-                        f"🆕 New Order Request\n\n"
-                        f"User: @{username} (id: {user_id})\n"
-                        f"Product: {product.title()}\n"
-                        f"Plan: {duration} Days\n"
-                        f"Amount: ₹{price}\n"
-                        f"Status: Pending\n"
-                        f"Order ID: {order_id}"
-                    ),
-                    reply_markup=admin_kb
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=(
-                        f"🆕 New Order Request\n\n"
-                        f"User: @{username} (id: {user_id})\n"
-                        f"Product: {product.title()}\n"
-                        f"Plan: {duration} Days\n"
-                        f"Amount: ₹{price}\n"
-                        f"Status: Pending\n"
-                        f"Transaction ID: {update.message.text}\n"
-                        f"Order ID: {order_id}"
-                    ),
-                    reply_markup=admin_kb
-                )
-        except Exception as e:
-            logger.error(f"Error forwarding to admin {admin_id}: {e}")
+    summary = (
+        f"🆕 New Order Request\n\n"
+        f"User: @{username} (id: {user_id})\n"
+        f"Product: {product.title()}\n"
+        f"Plan: {duration} Days\n"
+        f"Amount: ₹{price}\n"
+        f"Status: Pending\n"
+        f"Key: {'🔒 reserved' if reserved else '⚠️ not reserved (none in stock or user already holds one)'}\n"
+    )
+    if matched:
+        summary += "Ledger: ✅ payment matched, no key in stock\n"
+    if update.message.photo:
+        photo_id = update.message.photo[-1].file_id
+        sends = [
+            (admin_id, functools.partial(
+                context.bot.send_photo, chat_id=admin_id, photo=photo_id,
+                caption=summary + f"Order ID: {order_id}", reply_markup=admin_kb
+            ))
+            for admin_id in ADMIN_IDS
+        ]
+    else:
+        sends = [
+            (admin_id, functools.partial(
+                context.bot.send_message, chat_id=admin_id,
+                text=summary + f"Transaction ID: {update.message.text}\nOrder ID: {order_id}", reply_markup=admin_kb
+            ))
+            for admin_id in ADMIN_IDS
+        ]
     
+    # Reply to the buyer first; admin notifications go out in the background
     await update.message.reply_text(
         "✅ Your payment proof has been submitted. Please wait for admin verification.",
         reply_markup=cancel_keyboard()
     )
+    context.application.create_task(fan_out(sends, f"new order {order_id}"), update=update)
     context.user_data.clear()
     return ConversationHandler.END
 
+def key_delivery_text(order, key_value: str) -> str:
+    expiry = (datetime.now() + timedelta(days=order["duration_days"])).strftime("%Y-%m-%d")
+    return (
+        f"✅ Payment Verified!\n\n"
+        f"Here is your {order['product_name'].title()} - {order['duration_days']} Days Key:\n\n"
+        f"👉 {key_value}\n\n"
+        f"📅 Expiry: {expiry}"
+    )
+
+class OrderClaimConflict(Exception):
+    """The order changed after its key was picked; the claim is rolled back."""
+
+async def claim_key_for_order(conn, order_id: str, approved_by: str) -> Optional[asyncpg.Record]:
+    """Atomically claim a key for a pending order in one round trip.
+
+    Returns the approved order (user_id, username, product_name, duration_days,
+    amount, key_value) or None if nothing was claimed.
+    """
+    try:
+        async with conn.transaction():
+            row = await conn.run("claim_key", order_id, approved_by, mode="fetchrow")
+            if row is not None and row["user_id"] is None:
+                # The order was approved/rejected concurrently after our key was
+                # picked; roll back so the key, its hold and the sale stay untouched
+                raise OrderClaimConflict(order_id)
+    except OrderClaimConflict:
+        return None
+    return row
+
 async def approve_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     await q.answer()
     logger.info(f"approve clicked: data={q.data}, user={q.from_user.id}, admins={ADMIN_IDS}")
     
-    order_id = q.data.split("_", 1)[1]
+    order_id = q.data.rsplit("_", 1)[1]
+    respond = pending_action_responder(q)
     order = None
-    key_value = None
+    current = None
     
     try:
         if q.from_user.id not in ADMIN_IDS:
-            await q.edit_message_text("⚠️ You are not authorized to perform this action.")
+            await respond("⚠️ You are not authorized to perform this action.")
             return
         
         # Get a connection with retry logic
@@ -363,62 +1679,12 @@ async def approve_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         for attempt in range(max_retries):
             try:
                 async with db_pool.acquire() as conn:
-                    # First, get the order details
-                    order = await conn.fetchrow("SELECT * FROM orders WHERE id=$1", order_id)
+                    order = await claim_key_for_order(conn, order_id, str(q.from_user.id))
                     if not order:
-                        await q.edit_message_text("⚠️ Order not found.")
-                        return
-                    if order["status"] != "pending":
-                        await q.edit_message_text(f"⚠️ This order is already {order['status']}.")
-                        return
-                    
-                    # Check if keys are available
-                    kr = await conn.fetchrow("""
-                        SELECT id, key_value FROM keys
-                        WHERE duration_days=$1 AND product_name=$2 AND is_used=FALSE
-                        ORDER BY added_at
-                        LIMIT 1
-                    """, order["duration_days"], order["product_name"])
-                    
-                    if not kr:
-                        await q.edit_message_text(
-                            f"⚠️ No keys available for {order['product_name']} - {order['duration_days']} days plan."
-                        )
-                        try:
-                            await context.bot.send_message(
-                                chat_id=int(order["user_id"]),
-                                text="⚠️ Sorry, no keys available for your selected plan right now. Please contact support."
-                            )
-                        except Exception:
-                            pass
-                        return
-                    
-                    key_id = kr["id"]
-                    key_value = kr["key_value"]
-                    
-                    # Now perform the transaction
-                    async with conn.transaction():
-                        # CockroachDB preview feature to avoid multiple active portals error
-                        try:
-                            await conn.execute("SET SESSION multiple_active_portals_enabled = true")
-                        except Exception:
-                            pass
-                        
-                        # Execute updates
-                        await conn.execute("UPDATE keys SET is_used=TRUE WHERE id=$1", key_id)
-                        await conn.execute("""
-                            UPDATE orders
-                            SET status='approved', key_assigned=$1, approved_at=now(), approved_by=$2
-                            WHERE id=$3
-                        """, key_value, str(q.from_user.id), order_id)
-                        await conn.execute("""
-                            INSERT INTO sales_history (user_id, username, product_name, duration_days, amount, key_given)
-                            VALUES ($1, $2, $3, $4, $5, $6)
-                        """, order["user_id"], order["username"], order["product_name"],
-                             order["duration_days"], order["amount"], key_value)
-                    
-                    # If we got here, everything succeeded
-                    break
+                        # Only the failure path pays for a second read, to explain why
+                        current = await conn.run("order_status", order_id, mode="fetchrow")
+                # If we got here, the claim either succeeded or definitively failed
+                break
                     
             except (asyncpg.exceptions.ConnectionDoesNotExistError, 
                     asyncpg.exceptions._base.InterfaceError,
@@ -429,24 +1695,35 @@ async def approve_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                 # Wait a bit before retrying
                 await asyncio.sleep(1)
         
-        if not order or not key_value:
-            await q.edit_message_text("⚠️ Failed to process order. Please try again.")
+        if not order:
+            if not current:
+                await respond("⚠️ Order not found.")
+            elif current["status"] != "pending":
+                await respond(f"⚠️ This order is already {current['status']}.")
+            else:
+                # Resync the cached count for this product instead of trusting it
+                await get_stock_counts(current["product_name"], fresh=True)
+                await respond(
+                    f"⚠️ No keys available for {current['product_name']} - {current['duration_days']} days plan."
+                )
+                try:
+                    await context.bot.send_message(
+                        chat_id=int(current["user_id"]),
+                        text="⚠️ Sorry, no keys available for your selected plan right now. Please contact support."
+                    )
+                except Exception:
+                    pass
             return
         
-        expiry = (datetime.now() + timedelta(days=order["duration_days"])).strftime("%Y-%m-%d")
+        key_value = order["key_value"]
+        if not order["reserved"]:
+            adjust_stock(order["product_name"], order["duration_days"], -1)
+        
         try:
-            await context.bot.send_message(
-                chat_id=int(order["user_id"]),
-                text=(
-                    f"✅ Payment Verified!\n\n"
-                    f"Here is your {order['product_name'].title()} - {order['duration_days']} Days Key:\n\n"
-                    f"👉 {key_value}\n\n"
-                    f"📅 Expiry: {expiry}"
-                )
-            )
+            await context.bot.send_message(chat_id=int(order["user_id"]), text=key_delivery_text(order, key_value))
         except Exception as e:
             logger.error(f"Send key to user failed: {e}")
-        await q.edit_message_text(
+        await respond(
             f"✅ Order Approved!\n\n"
             f"User: @{order['username']} (id: {order['user_id']})\n"
             f"Product: {order['product_name'].title()}\n"
@@ -457,27 +1734,30 @@ async def approve_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     except Exception:
         logger.exception("approve_order failed")
         try:
-            await q.edit_message_text("⚠️ An error occurred while approving. Please check logs.")
+            await respond("⚠️ An error occurred while approving. Please check logs.")
         except Exception:
             pass
 
 async def reject_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     await q.answer()
+    respond = pending_action_responder(q)
     if q.from_user.id not in ADMIN_IDS:
-        await q.edit_message_text("⚠️ You are not authorized to perform this action.")
+        await respond("⚠️ You are not authorized to perform this action.")
         return
     
-    order_id = q.data.split("_", 1)[1]
+    order_id = q.data.rsplit("_", 1)[1]
     async with db_pool.acquire() as conn:
-        order = await conn.fetchrow("SELECT * FROM orders WHERE id=$1", order_id)
+        order = await conn.run("reject_order", order_id, mode="fetchrow")
         if not order:
-            await q.edit_message_text("⚠️ Order not found.")
-            return
-        if order["status"] != "pending":
-            await q.edit_message_text(f"⚠️ This order is already {order['status']}.")
+            current = await conn.run("order_status", order_id, mode="fetchrow")
+            if not current:
+                await respond("⚠️ Order not found.")
+            else:
+                await respond(f"⚠️ This order is already {current['status']}.")
             return
-        await conn.execute("UPDATE orders SET status='rejected' WHERE id=$1", order_id)
+    if order["released"]:
+        adjust_stock(order["product_name"], order["duration_days"], +order["released"])
     
     try:
         await context.bot.send_message(
@@ -485,15 +1765,105 @@ async def reject_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             text="❌ Payment not verified. Please try again or contact support."
         )
     except Exception:
-        pass
-    await q.edit_message_text(
-        f"❌ Order Rejected!\n\n"
-        f"User: @{order['username']} (id: {order['user_id']})\n"
-        f"Product: {order['product_name'].title()}\n"
-        f"Plan: {order['duration_days']} Days\n"
-        f"Amount: ₹{order['amount']}"
+        pass
+    await respond(
+        f"❌ Order Rejected!\n\n"
+        f"User: @{order['username']} (id: {order['user_id']})\n"
+        f"Product: {order['product_name'].title()}\n"
+        f"Plan: {order['duration_days']} Days\n"
+        f"Amount: ₹{order['amount']}"
+    )
+
+class BatchApprovalConflict(Exception):
+    """An order or key in the batch changed after it was locked; the batch is rolled back."""
+
+async def claim_batch(conn, product: str, duration: int, limit: int, approved_by: str) -> list[asyncpg.Record]:
+    """Approve up to `limit` of the oldest pending orders for one plan in a single
+    transaction, oldest key to oldest order. Returns the approved rows
+    (order_id, key_value, user_id, username, product_name, duration_days, amount)."""
+    async with conn.transaction():
+        rows = await conn.run("claim_batch", product, duration, limit, approved_by)
+        if any(r["user_id"] is None for r in rows) or (rows and rows[0]["claimed"] != len(rows)):
+            raise BatchApprovalConflict(f"{product} {duration}d batch lost a race")
+    return rows
+
+async def approve_batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⚠️ You are not authorized to use this command.")
+        return
+
+    if len(context.args) not in (2, 3):
+        shorts = get_available_product_shorts()
+        await update.message.reply_text(
+            f"Usage: /approve_batch <days> <product_short> [count]\n"
+            f"Approves the oldest pending orders for that plan (up to {BATCH_APPROVE_MAX}).\n\n"
+            "Available products: " + (", ".join(shorts) if shorts else "none")
+        )
+        return
+
+    try:
+        days = int(context.args[0])
+        product_short = context.args[1].strip().lower()
+        count = int(context.args[2]) if len(context.args) == 3 else BATCH_APPROVE_MAX
+        if days not in DEFAULT_PLANS:
+            await update.message.reply_text(f"⚠️ Invalid duration. Valid options: {', '.join(map(str, DEFAULT_PLANS))}")
+            return
+        if not 0 < count <= BATCH_APPROVE_MAX:
+            await update.message.reply_text(f"⚠️ Count must be between 1 and {BATCH_APPROVE_MAX}.")
+            return
+
+        product_name = get_full_name_by_short(product_short)
+        if not product_name:
+            shorts = get_available_product_shorts()
+            await update.message.reply_text(f"⚠️ Invalid product. Available: {', '.join(shorts) if shorts else 'none'}")
+            return
+
+        async with db_pool.acquire() as conn:
+            rows = await claim_batch(conn, product_name, days, count, str(update.effective_user.id))
+    except ValueError:
+        await update.message.reply_text("⚠️ Invalid number. Please provide valid days and count.")
+        return
+    except BatchApprovalConflict:
+        logger.warning("approve_batch rolled back after a concurrent change")
+        await update.message.reply_text("⚠️ Some orders changed while approving; nothing was approved. Please retry.")
+        return
+    except Exception:
+        logger.exception("Error approving batch")
+        await update.message.reply_text("⚠️ An error occurred while approving. Please check logs.")
+        return
+
+    if not rows:
+        await get_stock_counts(product_name, fresh=True)
+        await update.message.reply_text(
+            f"ℹ️ Nothing to approve for {product_name.title()} - {days} days: "
+            f"no pending orders or no keys left."
+        )
+        return
+
+    adjust_stock(product_name, days, -sum(not r["reserved"] for r in rows))
+    await update.message.reply_text(
+        f"✅ Approved {len(rows)} order(s) for {product_name.title()} - {days} days.\n"
+        f"Delivering keys..."
     )
 
+    async def deliver():
+        sends = [
+            (int(r["user_id"]), functools.partial(
+                context.bot.send_message, chat_id=int(r["user_id"]), text=key_delivery_text(r, r["key_value"])
+            ))
+            for r in rows
+        ]
+        delivered = await fan_out(sends, f"batch {product_name} {days}d")
+        failed = [r for r, ok in zip(rows, delivered) if not ok]
+        text = f"📬 Batch delivery: {len(rows) - len(failed)}/{len(rows)} delivered."
+        if failed:
+            text += "\n\nNot delivered (key is assigned on the order):\n" + "\n".join(
+                f"@{r['username']} (id: {r['user_id']}) order {r['order_id']}: {r['key_value']}" for r in failed
+            )
+        await update.message.reply_text(text)
+
+    context.application.create_task(deliver(), update=update)
+
 # ===== ADMIN: KEYS =====
 async def add_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
@@ -501,9 +1871,11 @@ async def add_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     if len(context.args) != 3:
-        shorts = await get_available_product_shorts()
+        shorts = get_available_product_shorts()
         await update.message.reply_text(
-            "Usage: /add_key <days> <key> <product_short>\n\n"
+            "Usage: /add_key <days> <key> <product_short>\n"
+            "Bulk: /add_keys <days> <product_short> with one key per line below, "
+            "or as the caption of a .txt/.csv file\n\n"
             "Available products: " + (", ".join(shorts) if shorts else "none")
         )
         return
@@ -518,9 +1890,9 @@ async def add_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await update.message.reply_text(f"⚠️ Invalid duration. Valid options: {', '.join(map(str, DEFAULT_PLANS))}")
             return
         
-        product_name = await get_full_name_by_short(product_short)
+        product_name = get_full_name_by_short(product_short)
         if not product_name:
-            shorts = await get_available_product_shorts()
+            shorts = get_available_product_shorts()
             await update.message.reply_text(f"⚠️ Invalid product. Available: {', '.join(shorts) if shorts else 'none'}")
             return
         
@@ -533,6 +1905,7 @@ async def add_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 "INSERT INTO keys (duration_days, key_value, product_name) VALUES ($1, $2, $3)",
                 days, key, product_name
             )
+        adjust_stock(product_name, days, +1)
         
         await update.message.reply_text(f"✅ Key added successfully for {product_name.title()} - {days} days plan.")
     except ValueError:
@@ -541,23 +1914,100 @@ async def add_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.exception("__main__ - ERROR - Error adding key")
         await update.message.reply_text("⚠️ An error occurred while adding the key.")
 
+async def read_bulk_keys(update: Update) -> tuple[list[str], list[str]]:
+    """Split a bulk key command into (args, keys).
+
+    Args come from the first line of the message (or the document caption).
+    Keys are every following non-empty line of a text message, or every line
+    (first column for .csv) of an attached document.
+    """
+    msg = update.message
+    if msg.document:
+        args = (msg.caption or "").split()[1:]
+        tg_file = await msg.document.get_file()
+        raw = bytes(await tg_file.download_as_bytearray()).decode("utf-8-sig", errors="replace")
+        if (msg.document.file_name or "").lower().endswith(".csv"):
+            import csv
+            keys = [row[0].strip() for row in csv.reader(raw.splitlines()) if row and row[0].strip()]
+        else:
+            keys = [line.strip() for line in raw.splitlines() if line.strip()]
+        return args, keys
+    
+    first, _, rest = (msg.text or "").partition("\n")
+    return first.split()[1:], [line.strip() for line in rest.splitlines() if line.strip()]
+
+async def add_keys(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⚠️ You are not authorized to use this command.")
+        return
+    
+    try:
+        args, keys = await read_bulk_keys(update)
+        if len(args) != 2 or not keys:
+            shorts = get_available_product_shorts()
+            await update.message.reply_text(
+                "Usage: /add_keys <days> <product_short>\n<key1>\n<key2>\n...\n"
+                "or send a .txt/.csv file (one key per line) with that command as the caption.\n\n"
+                "Available products: " + (", ".join(shorts) if shorts else "none")
+            )
+            return
+        
+        days = int(args[0])
+        product_short = args[1].strip().lower()
+        if days not in DEFAULT_PLANS:
+            await update.message.reply_text(f"⚠️ Invalid duration. Valid options: {', '.join(map(str, DEFAULT_PLANS))}")
+            return
+        
+        product_name = get_full_name_by_short(product_short)
+        if not product_name:
+            shorts = get_available_product_shorts()
+            await update.message.reply_text(f"⚠️ Invalid product. Available: {', '.join(shorts) if shorts else 'none'}")
+            return
+        
+        unique = list(dict.fromkeys(keys))
+        inserted = 0
+        try:
+            async with db_pool.acquire() as conn:
+                for i in range(0, len(unique), KEY_BATCH_SIZE):
+                    rows = await conn.fetch("""
+                        INSERT INTO keys (duration_days, key_value, product_name)
+                        SELECT $1, k, $3 FROM unnest($2::STRING[]) AS k
+                        ON CONFLICT (key_value) DO NOTHING
+                        RETURNING key_value
+                    """, days, unique[i:i + KEY_BATCH_SIZE], product_name)
+                    # Each batch commits on its own, so count it in the cache right away
+                    inserted += len(rows)
+                    adjust_stock(product_name, days, +len(rows))
+        except Exception:
+            logger.exception("Error bulk adding keys")
+            await update.message.reply_text(
+                f"⚠️ Bulk import for {product_name.title()} - {days} days plan stopped by an error.\n\n"
+                f"Received: {len(keys)}\n"
+                f"Inserted before the error: {inserted}\n\n"
+                "Send the same upload again to import the rest; existing keys are skipped."
+            )
+            return
+        
+        await update.message.reply_text(
+            f"✅ Bulk import for {product_name.title()} - {days} days plan:\n\n"
+            f"Received: {len(keys)}\n"
+            f"Inserted: {inserted}\n"
+            f"Duplicates in upload: {len(keys) - len(unique)}\n"
+            f"Already in database: {len(unique) - inserted}"
+        )
+    except ValueError:
+        await update.message.reply_text("⚠️ Invalid duration. Please provide a valid number.")
+    except Exception:
+        logger.exception("Error bulk adding keys")
+        await update.message.reply_text("⚠️ An error occurred while importing the keys.")
+
 async def list_keys(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("⚠️ You are not authorized to use this command.")
         return
     
-    await load_products_from_db()
     message = "🔑 Available Keys:\n\n"
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT product_name, duration_days, COUNT(*) AS cnt
-            FROM keys
-            WHERE is_used=FALSE
-            GROUP BY product_name, duration_days
-            ORDER BY product_name, duration_days
-        """)
-    
-    counts = {(r["product_name"], r["duration_days"]): r["cnt"] for r in rows}
+    counts = await get_stock_counts(fresh=True)
     for product in PRODUCTS:
         message += f"📦 {product.title()}:\n"
         for days in DEFAULT_PLANS:
@@ -574,9 +2024,12 @@ async def remove_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         return
     
     if len(context.args) != 3:
-        shorts = await get_available_product_shorts()
+        shorts = get_available_product_shorts()
         await update.message.reply_text(
-            "Usage: /remove_key <days> <key> <product_short>\n\n"
+            "Usage: /remove_key <days> <key> <product_short>\n"
+            "Bulk: /remove_keys <days> <product_short> with one key per line below, "
+            "or as the caption of a .txt/.csv file\n"
+            "Purge unused stock: /purge_keys <product_short> [days]\n\n"
             "Available products: " + (", ".join(shorts) if shorts else "none")
         )
         return
@@ -586,21 +2039,22 @@ async def remove_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         key = context.args[1].strip()
         product_short = context.args[2].strip().lower()  # Fixed: was context.args.strip()
         
-        product_name = await get_full_name_by_short(product_short)
+        product_name = get_full_name_by_short(product_short)
         if not product_name:
-            shorts = await get_available_product_shorts()
+            shorts = get_available_product_shorts()
             await update.message.reply_text(f"⚠️ Invalid product. Available: {', '.join(shorts) if shorts else 'none'}")
             return
         
         async with db_pool.acquire() as conn:
             rec = await conn.fetchrow("""
                 SELECT * FROM keys
-                WHERE duration_days=$1 AND key_value=$2 AND product_name=$3 AND is_used=FALSE
+                WHERE duration_days=$1 AND key_value=$2 AND product_name=$3 AND is_used=FALSE AND reserved_for IS NULL
             """, days, key, product_name)
             if not rec:
                 await update.message.reply_text("⚠️ Key not found or already used.")
                 return
             await conn.execute("DELETE FROM keys WHERE id=$1", rec["id"])
+        adjust_stock(product_name, days, -1)
         
         await update.message.reply_text(f"✅ Key removed successfully from {product_name.title()} - {days} days plan.")
     except ValueError:
@@ -609,6 +2063,174 @@ async def remove_key(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         logger.exception("Error removing key")
         await update.message.reply_text("⚠️ An error occurred while removing the key.")
 
+async def remove_keys(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⚠️ You are not authorized to use this command.")
+        return
+    
+    try:
+        args, keys = await read_bulk_keys(update)
+        if len(args) != 2 or not keys:
+            shorts = get_available_product_shorts()
+            await update.message.reply_text(
+                "Usage: /remove_keys <days> <product_short>\n<key1>\n<key2>\n...\n"
+                "or send a .txt/.csv file (one key per line) with that command as the caption.\n\n"
+                "Available products: " + (", ".join(shorts) if shorts else "none")
+            )
+            return
+        
+        days = int(args[0])
+        product_short = args[1].strip().lower()
+        if days not in DEFAULT_PLANS:
+            await update.message.reply_text(f"⚠️ Invalid duration. Valid options: {', '.join(map(str, DEFAULT_PLANS))}")
+            return
+        
+        product_name = get_full_name_by_short(product_short)
+        if not product_name:
+            shorts = get_available_product_shorts()
+            await update.message.reply_text(f"⚠️ Invalid product. Available: {', '.join(shorts) if shorts else 'none'}")
+            return
+        
+        unique = list(dict.fromkeys(keys))
+        removed = 0
+        try:
+            async with db_pool.acquire() as conn:
+                for i in range(0, len(unique), KEY_BATCH_SIZE):
+                    rows = await conn.fetch("""
+                        DELETE FROM keys
+                        WHERE key_value = ANY($1::STRING[]) AND duration_days=$2 AND product_name=$3
+                            AND is_used=FALSE AND reserved_for IS NULL
+                        RETURNING key_value
+                    """, unique[i:i + KEY_BATCH_SIZE], days, product_name)
+                    # Each batch commits on its own, so count it in the cache right away
+                    removed += len(rows)
+                    adjust_stock(product_name, days, -len(rows))
+        except Exception:
+            logger.exception("Error bulk removing keys")
+            await update.message.reply_text(
+                f"⚠️ Bulk removal for {product_name.title()} - {days} days plan stopped by an error.\n\n"
+                f"Received: {len(keys)}\n"
+                f"Removed before the error: {removed}\n\n"
+                "Send the same upload again to remove the rest."
+            )
+            return
+        
+        await update.message.reply_text(
+            f"✅ Bulk removal for {product_name.title()} - {days} days plan:\n\n"
+            f"Received: {len(keys)}\n"
+            f"Removed: {removed}\n"
+            f"Not found or already used: {len(unique) - removed}"
+        )
+    except ValueError:
+        await update.message.reply_text("⚠️ Invalid duration. Please provide a valid number.")
+    except Exception:
+        logger.exception("Error bulk removing keys")
+        await update.message.reply_text("⚠️ An error occurred while removing the keys.")
+
+async def purge_keys(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⚠️ You are not authorized to use this command.")
+        return
+    
+    if len(context.args) not in (1, 2):
+        shorts = get_available_product_shorts()
+        await update.message.reply_text(
+            "Usage: /purge_keys <product_short> [days]\n"
+            "Deletes every unused key of the product (or of one plan). Used keys are never touched.\n\n"
+            "Available products: " + (", ".join(shorts) if shorts else "none")
+        )
+        return
+    
+    product_short = context.args[0].strip().lower()
+    product_name = get_full_name_by_short(product_short)
+    if not product_name:
+        shorts = get_available_product_shorts()
+        await update.message.reply_text(f"⚠️ Invalid product. Available: {', '.join(shorts) if shorts else 'none'}")
+        return
+    
+    days = "all"
+    if len(context.args) == 2:
+        if not context.args[1].isdigit() or int(context.args[1]) not in DEFAULT_PLANS:
+            await update.message.reply_text(f"⚠️ Invalid duration. Valid options: {', '.join(map(str, DEFAULT_PLANS))}")
+            return
+        days = context.args[1]
+    
+    duration = None if days == "all" else int(days)
+    async with db_pool.acquire() as conn:
+        total, newest = await conn.fetchrow("""
+            SELECT count(*), max(added_at) FROM keys
+            WHERE product_name=$1 AND is_used=FALSE AND reserved_for IS NULL
+                AND ($2::INT IS NULL OR duration_days=$2)
+        """, product_name, duration)
+    plan_text = "all plans" if days == "all" else f"{days} days plan"
+    if not total:
+        await update.message.reply_text(f"Nothing to purge: {product_name.title()} - {plan_text} has no unused keys.")
+        return
+    
+    # The confirm button only deletes keys added up to this preview, so a restock
+    # between preview and click survives (cutoff encoded like _encode_cursor)
+    cutoff = (newest - _EPOCH) // timedelta(microseconds=1) if newest else 0
+    kb = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Confirm Purge", callback_data=f"purge_keys::{product_short}::{days}::{cutoff}"),
+        InlineKeyboardButton("❌ Cancel", callback_data="cancel"),
+    ]])
+    await update.message.reply_text(
+        f"Purge {total} unused keys of {product_name.title()} - {plan_text}?",
+        reply_markup=kb
+    )
+
+async def purge_keys_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    await q.answer()
+    if q.from_user.id not in ADMIN_IDS:
+        await q.edit_message_text("⚠️ You are not authorized to perform this action.")
+        return
+    
+    parts = q.data.split("::")
+    if len(parts) != 4:
+        await q.edit_message_text("⚠️ This confirmation has expired. Run /purge_keys again.")
+        return
+    _, product_short, days, cutoff = parts
+    product_name = get_full_name_by_short(product_short)
+    if not product_name:
+        await q.edit_message_text("⚠️ Product not found or already removed.")
+        return
+    
+    duration = None if days == "all" else int(days)
+    added_before = _EPOCH + timedelta(microseconds=int(cutoff))
+    removed: dict[int, int] = {}
+    try:
+        async with db_pool.acquire() as conn:
+            while True:
+                rows = await conn.fetch("""
+                    DELETE FROM keys
+                    WHERE is_used=FALSE AND reserved_for IS NULL AND id IN (
+                        SELECT id FROM keys
+                        WHERE product_name=$1 AND is_used=FALSE AND reserved_for IS NULL
+                            AND ($2::INT IS NULL OR duration_days=$2)
+                            AND (added_at IS NULL OR added_at <= $4)
+                        LIMIT $3
+                    )
+                    RETURNING duration_days
+                """, product_name, duration, KEY_BATCH_SIZE, added_before)
+                for r in rows:
+                    removed[r["duration_days"]] = removed.get(r["duration_days"], 0) + 1
+                if len(rows) < KEY_BATCH_SIZE:
+                    break
+    except Exception:
+        logger.exception("Error purging keys")
+        await q.edit_message_text("⚠️ An error occurred while purging keys. Some keys may have been removed.")
+        return
+    finally:
+        for d, n in removed.items():
+            adjust_stock(product_name, d, -n)
+    
+    lines = [f"  🗑️ {d} Days: {n} keys" for d, n in sorted(removed.items())]
+    await q.edit_message_text(
+        f"✅ Purged {sum(removed.values())} unused keys from {product_name.title()}.\n\n"
+        + ("\n".join(lines) if lines else "Nothing to remove.")
+    )
+
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("⚠️ You are not authorized to use this command.")
@@ -644,25 +2266,200 @@ async def export_history(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     try:
-        import csv, io
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(["Date", "User ID", "Username", "Product", "Duration (Days)", "Amount", "Key Given"])
-        
-        async with db_pool.acquire() as conn:
-            sales = await conn.fetch("SELECT * FROM sales_history ORDER BY created_at DESC")
+        import csv, io, tempfile
+        # Rows are streamed from a server-side cursor into a spooled temp file
+        # (memory up to EXPORT_SPOOL_BYTES, disk beyond) one encoded chunk at a
+        # time, and uploaded straight from the file handle, so peak memory stays flat
+        spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
         
-        for s in sales:
-            created_at = s["created_at"].strftime("%Y-%m-%d %H:%M:%S")
-            writer.writerow([created_at, s["user_id"], s["username"], s["product_name"], s["duration_days"], s["amount"], s["key_given"]])
+        def write_rows(rows) -> None:
+            buf = io.StringIO(newline="")
+            csv.writer(buf).writerows(rows)
+            spool.write(buf.getvalue().encode("utf-8"))
         
-        bio = io.BytesIO(output.getvalue().encode("utf-8"))
-        bio.name = "sales_history.csv"
-        await update.bot.send_document(chat_id=update.effective_chat.id, document=bio, caption="📊 Sales History Export")
+        try:
+            write_rows([["Date", "User ID", "Username", "Product", "Duration (Days)", "Amount", "Key Given"]])
+            async with db_pool.acquire() as conn:
+                async with conn.transaction(readonly=True):
+                    cur = await conn.cursor("""
+                        SELECT created_at, user_id, username, product_name, duration_days, amount, key_given
+                        FROM sales_history
+                        ORDER BY created_at DESC
+                    """)
+                    while True:
+                        sales = await cur.fetch(EXPORT_CHUNK_ROWS)
+                        if not sales:
+                            break
+                        write_rows(
+                            [s["created_at"].strftime("%Y-%m-%d %H:%M:%S"), s["user_id"], s["username"],
+                             s["product_name"], s["duration_days"], s["amount"], s["key_given"]]
+                            for s in sales
+                        )
+            
+            spool.seek(0)
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=InputFile(spool, filename="sales_history.csv", read_file_handle=False),
+                caption="📊 Sales History Export"
+            )
+        finally:
+            spool.close()
     except Exception:
         logger.exception("Error exporting history")
         await update.message.reply_text("⚠️ An error occurred while exporting the sales history.")
 
+async def rebuild_sales_rollup(conn) -> None:
+    """Recompute sales_daily_rollup from sales_history in one transaction."""
+    async with conn.transaction():
+        await conn.execute("DELETE FROM sales_daily_rollup")
+        await conn.execute(ROLLUP_BACKFILL_SQL)
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⚠️ You are not authorized to use this command.")
+        return
+
+    try:
+        if context.args and context.args[0].lower() == "rebuild":
+            async with db_pool.acquire() as conn:
+                await rebuild_sales_rollup(conn)
+            await update.message.reply_text("✅ Daily sales rollup rebuilt from sales history.")
+            return
+        days = int(context.args[0]) if context.args else 30
+        if not 1 <= days <= 366:
+            raise ValueError(days)
+    except ValueError:
+        await update.message.reply_text("Usage: /stats [days] (1-366, default 30)\n/stats rebuild recomputes the rollup.")
+        return
+    except Exception:
+        logger.exception("Error rebuilding sales rollup")
+        await update.message.reply_text("⚠️ An error occurred while rebuilding the rollup.")
+        return
+
+    async with db_pool.acquire() as conn:
+        rows = await conn.run("sales_stats", days)
+
+    if not rows:
+        await update.message.reply_text(f"📈 No sales in the last {days} days.")
+        return
+
+    def total(col: str):
+        return sum(r[col] for r in rows)
+
+    message = f"📈 Sales Stats\n\nToday: {total('units_today')} sold · ₹{total('revenue_today')}\n"
+    if days > 7:
+        message += f"Last 7 days: {total('units_week')} sold · ₹{total('revenue_week')}\n"
+    message += (
+        f"Last {days} days: {total('units')} sold · ₹{total('revenue')}\n\n"
+        f"By plan (last {days} days):\n"
+    )
+    product = None
+    for r in rows:
+        if r["product_name"] != product:
+            product = r["product_name"]
+            message += f"\n📦 {product.title()}:\n"
+        message += (
+            f"  🔑 {r['duration_days']} Days: {r['units']} sold · ₹{r['revenue']} "
+            f"(today {r['units_today']}, 7d {r['units_week']})\n"
+        )
+
+    await update.message.reply_text(message)
+
+# ===== ADMIN: PENDING ORDERS =====
+_EPOCH = datetime(1970, 1, 1)
+_FIRST_CURSOR = (_EPOCH, uuid.UUID(int=0))
+
+def _encode_cursor(created_at: datetime, order_id: uuid.UUID) -> str:
+    # Compact enough for Telegram's 64-byte callback_data limit
+    return f"{(created_at - _EPOCH) // timedelta(microseconds=1)}:{order_id.hex}"
+
+def _decode_cursor(value: str) -> tuple[datetime, uuid.UUID]:
+    us, hex_id = value.split(":", 1)
+    return _EPOCH + timedelta(microseconds=int(us)), uuid.UUID(hex=hex_id)
+
+def pending_action_responder(q):
+    """How approve_order/reject_order report back. Buttons on an order's own
+    notification (approve_/reject_) edit that message. Buttons on a /pending page
+    (pending_approve_/pending_reject_) post the result as a new message and drop
+    the order's row of buttons, leaving the page and its position in place."""
+    if not q.data.startswith("pending_"):
+        return q.edit_message_text
+    
+    async def respond(text: str) -> None:
+        order_id = q.data.rsplit("_", 1)[1]
+        await q.message.reply_text(text)
+        rows = [
+            row for row in q.message.reply_markup.inline_keyboard
+            if not any(b.callback_data.endswith(order_id) for b in row)
+        ]
+        with contextlib.suppress(BadRequest):
+            await q.edit_message_reply_markup(InlineKeyboardMarkup(rows))
+    
+    return respond
+
+async def render_pending_page(direction: str = ">", cursor: Optional[str] = None):
+    """One page of pending orders, oldest first, with approve/reject buttons.
+
+    `direction` is ">" (rows after `cursor`) or "<" (rows before it). Pages are
+    fetched by keyset on (created_at, id), never with OFFSET.
+    """
+    created_at, order_id = _decode_cursor(cursor) if cursor else _FIRST_CURSOR
+    stmt = "pending_after" if direction == ">" else "pending_before"
+    async with db_pool.acquire() as conn:
+        rows = await conn.run(stmt, created_at, order_id, PENDING_PAGE_SIZE + 1)
+    
+    more = len(rows) > PENDING_PAGE_SIZE
+    rows = rows[:PENDING_PAGE_SIZE]
+    if direction == "<":
+        rows = list(reversed(rows))
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = cursor is not None, more
+    
+    if not rows:
+        return "✅ No pending orders.", None
+    
+    lines = ["⏳ Pending Orders:\n"]
+    kb = []
+    for i, r in enumerate(rows, 1):
+        lines.append(
+            f"{i}. {r['created_at'].strftime('%Y-%m-%d %H:%M')} - @{r['username']} (id: {r['user_id']})\n"
+            f"   {r['product_name'].title()} - {r['duration_days']} Days - ₹{r['amount']}\n"
+            f"   Order ID: {r['id']}"
+        )
+        kb.append([
+            InlineKeyboardButton(f"✅ Approve #{i}", callback_data=f"pending_approve_{r['id']}"),
+            InlineKeyboardButton(f"❌ Reject #{i}", callback_data=f"pending_reject_{r['id']}"),
+        ])
+    
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"pending:<:{_encode_cursor(rows[0]['created_at'], rows[0]['id'])}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"pending:>:{_encode_cursor(rows[-1]['created_at'], rows[-1]['id'])}"))
+    if nav:
+        kb.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(kb)
+
+async def pending_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⚠️ You are not authorized to use this command.")
+        return
+    
+    text, kb = await render_pending_page()
+    await update.message.reply_text(text, reply_markup=kb)
+
+async def pending_page_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    await q.answer()
+    if q.from_user.id not in ADMIN_IDS:
+        await q.edit_message_text("⚠️ You are not authorized to perform this action.")
+        return
+    
+    _, direction, cursor = q.data.split(":", 2)
+    text, kb = await render_pending_page(direction, cursor)
+    await q.edit_message_text(text, reply_markup=kb)
+
 # ===== CANCEL HANDLERS =====
 async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.clear()
@@ -713,34 +2510,28 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # List products
     elif data == "admin_list_products":
-        await load_products_from_db()
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch("SELECT name, short_name FROM products WHERE is_active=TRUE ORDER BY name")
-        
-        if not rows:
+        catalog = CATALOG
+        if not catalog.active_names:
             text = "No active products found."
         else:
             text = "Active Products:\n" + "\n".join(
-                f"• {r['name'].title()} (/{r['short_name']})" if r["short_name"] 
-                else f"• {r['name'].title()} (no short)" 
-                for r in rows
+                f"• {name.title()} (/{catalog.short_for_name(name)})" if catalog.short_for_name(name)
+                else f"• {name.title()} (no short)"
+                for name in catalog.active_names
             )
         await q.edit_message_text(text)
         return ConversationHandler.END
     
     # Remove Product: menu (supports items with/without short_name)
     elif data == "admin_remove_product_menu":
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch("SELECT name, short_name FROM products WHERE is_active=TRUE ORDER BY name")
-        
-        if not rows:
+        catalog = CATALOG
+        if not catalog.active_names:
             await q.edit_message_text("No active products to remove.")
             return ConversationHandler.END
         
         buttons = []
-        for r in rows:
-            name = r["name"]
-            short = r["short_name"]
+        for name in catalog.active_names:
+            short = catalog.short_for_name(name)
             if short:
                 cb = f"admin_remove_product_short::{short}"
                 display = f"{name.title()} (/{short})"
@@ -760,14 +2551,11 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Remove using short_name
     elif data.startswith("admin_remove_product_short::"):
         short = data.split("::", 1)[1]
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT name FROM products WHERE short_name=$1 AND is_active=TRUE", short)
-        
-        if not row:
+        name = CATALOG.name_for_short(short)
+        if not name:
             await q.edit_message_text("⚠️ Product not found or already removed.")
             return ConversationHandler.END
         
-        name = row["name"]
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("✅ Confirm Remove", callback_data=f"admin_confirm_remove_short::{short}")],
             [InlineKeyboardButton("⬅️ Back", callback_data="admin_remove_product_menu"),
@@ -783,14 +2571,11 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith("admin_remove_product_name::"):
         safe_name = data.split("::", 1)[1]
         name = safe_name
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT short_name FROM products WHERE name=$1 AND is_active=TRUE", name)
-        
-        if not row:
+        if not CATALOG.is_active(name):
             await q.edit_message_text("⚠️ Product not found or already removed.")
             return ConversationHandler.END
         
-        short = row["short_name"]
+        short = CATALOG.short_for_name(name)
         short_text = f"/{short}" if short else "(no short)"
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("✅ Confirm Remove", callback_data=f"admin_confirm_remove_name::{name.replace('::','—')}")],
@@ -909,15 +2694,247 @@ async def admin_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop("admin_add_product", None)
     return ConversationHandler.END
 
+# ===== UPDATE PROCESSING =====
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently on up to `workers` slots while keeping the
+    updates of any one user (or chat, for updates without a user) strictly in
+    arrival order, so ConversationHandler state transitions stay correct.
+
+    A user's backlog waits on that user's lock before taking a worker slot, so
+    one busy user never holds more than one slot.
+    """
+    
+    def __init__(self, workers: int):
+        # The base class semaphore only needs to allow concurrency; the real
+        # bound is applied below, after the per-user lock
+        super().__init__(max_concurrent_updates=max(2, workers) * 1024)
+        self.workers = workers
+        self.queued = 0  # accepted but waiting for their user lock or a worker slot
+        self.running = 0
+        self._slots = asyncio.Semaphore(workers)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._refs: dict[int, int] = {}
+    
+    @staticmethod
+    def _key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+    
+    async def _run(self, coroutine) -> None:
+        async with self._slots:
+            self.queued -= 1
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+    
+    async def do_process_update(self, update: object, coroutine) -> None:
+        self.queued += 1
+        if self.queued == UPDATE_QUEUE_WARN:
+            logger.warning(f"Update backlog reached {self.queued} (workers={self.workers})")
+        
+        key = self._key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._refs[key] = self._refs.get(key, 0) + 1
+        try:
+            async with lock:
+                await self._run(coroutine)
+        finally:
+            self._refs[key] -= 1
+            if not self._refs[key]:
+                del self._refs[key]
+                del self._locks[key]
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+def update_queue_depth(application: Application) -> int:
+    """Updates received but not yet being handled (fetch queue + processor backlog)."""
+    processor = application.update_processor
+    backlog = processor.queued if isinstance(processor, OrderedUpdateProcessor) else 0
+    return application.update_queue.qsize() + backlog
+
+# ===== HTTP SERVER (webhook / health) =====
+async def serve_http(routes: dict, host: str, port: int) -> asyncio.AbstractServer:
+    """Minimal keep-alive HTTP/1.1 server on asyncio streams.
+
+    `routes` maps (method, path) -> async handler(headers, body) returning
+    (status, content_type, payload_bytes). Bodies over HTTP_MAX_BODY get a 413,
+    and a connection idle for HTTP_READ_TIMEOUT mid-request or between requests
+    is closed.
+    """
+    
+    def read(coro):
+        return asyncio.wait_for(coro, HTTP_READ_TIMEOUT)
+    
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await read(reader.readline())
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await read(reader.readline())
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                too_large = length > HTTP_MAX_BODY or length < 0
+                body = b"" if too_large else await read(reader.readexactly(length))
+                
+                route = routes.get((method, target.split("?", 1)[0]))
+                if too_large:
+                    status, ctype, payload = 413, "text/plain", b"payload too large"
+                elif route is None:
+                    status, ctype, payload = 404, "text/plain", b"not found"
+                else:
+                    try:
+                        status, ctype, payload = await route(headers, body)
+                    except Exception:
+                        logger.exception(f"HTTP handler failed: {method} {target}")
+                        status, ctype, payload = 500, "text/plain", b"error"
+                
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                    f"Content-Type: {ctype}\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+                # The unread body of a 413 makes the stream unusable, so close it
+                if too_large or headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+    
+    return await asyncio.start_server(handle, host, port)
+
+async def health_route(headers: dict, body: bytes):
+    """Readiness: 200 only while the migrated pool can run SELECT 1 within
+    HEALTH_CHECK_TIMEOUT, so a load balancer stops routing when the DB goes away."""
+    if not DB_READY.is_set():
+        status = "starting"
+    else:
+        try:
+            async def ping():
+                async with db_pool.acquire(timeout=HEALTH_CHECK_TIMEOUT) as conn:
+                    await conn.fetchval("SELECT 1")
+            await asyncio.wait_for(ping(), HEALTH_CHECK_TIMEOUT)
+            status = "ok"
+        except Exception as e:
+            logger.warning(f"Health check failed: {e!r}")
+            status = "db_unavailable"
+    payload = json.dumps({"status": status, "products": len(PRODUCTS)}).encode()
+    return (200 if status == "ok" else 503), "application/json", payload
+
+async def run_webhook(application: Application) -> None:
+    """Serve updates posted by Telegram (or a local fake poster) until SIGINT/SIGTERM."""
+    
+    async def webhook_route(headers: dict, body: bytes):
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return 403, "text/plain", b"forbidden"
+        update = Update.de_json(json.loads(body), application.bot)
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    
+    # Without a registered public URL only a local poster should reach the port
+    listen = WEBHOOK_LISTEN if WEBHOOK_URL else "127.0.0.1"
+    
+    async with application:
+        await application.start()
+        server = await serve_http({
+            ("POST", WEBHOOK_PATH): webhook_route,
+            ("GET", "/healthz"): health_route,
+        }, listen, WEBHOOK_PORT)
+        logger.info(f"Webhook server listening on {listen}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info(f"Webhook registered: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL not set; webhook not registered with Telegram (local mode)")
+        
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            await application.stop()
+
+async def startup(application: Application) -> None:
+    """Open the Telegram connection while the DB pool warms and the caches load
+    concurrently, then log where the startup time went."""
+    global _ledger_watcher, _reservation_sweeper
+    timings = {"imports": STARTUP_IMPORTS}
+    
+    async def timed(name: str, coro):
+        start = time.perf_counter()
+        await coro
+        timings[name] = time.perf_counter() - start
+    
+    async def db_startup():
+        await timed("db_pool", init_db_pool())
+        await asyncio.gather(
+            timed("catalog", load_products_from_db()),
+            timed("stock", refresh_stock_cache()),
+            timed("media_cache", load_media_cache()),
+        )
+    
+    await asyncio.gather(db_startup(), timed("telegram", application.initialize()))
+    _reservation_sweeper = asyncio.create_task(reservation_sweeper())
+    if LEDGER_DIR:
+        _ledger_watcher = asyncio.create_task(watch_ledger_dir())
+        logger.info(f"Watching {LEDGER_DIR} for UPI statement exports")
+    timings["ready"] = time.perf_counter() - STARTUP_T0
+    logger.info("Startup timings: " + ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items()))
+
 def main() -> None:
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is not set")
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_SECRET")
     
-    application = Application.builder().token(BOT_TOKEN).build()
-    
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(init_db_pool())
-    loop.run_until_complete(load_products_from_db())
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(OrderedUpdateProcessor(UPDATE_WORKERS))
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest())
+    )
+    persistent = PERSISTENCE_INTERVAL > 0
+    if persistent:
+        builder = builder.persistence(PostgresPersistence(PERSISTENCE_INTERVAL))
+    application = builder.build()
     
     # Order action handlers FIRST (so they are not shadowed)
     application.add_handler(CallbackQueryHandler(approve_order, pattern="^approve_"))
@@ -945,6 +2962,8 @@ def main() -> None:
         },
         fallbacks=[CommandHandler("cancel", cancel_cmd)],
         allow_reentry=True,
+        name="checkout",
+        persistent=persistent,
     )
     application.add_handler(conv_handler)
     
@@ -965,6 +2984,8 @@ def main() -> None:
         },
         fallbacks=[CallbackQueryHandler(cancel_cb, pattern="^cancel$")],
         allow_reentry=True,
+        name="admin_add_product",
+        persistent=persistent,
     )
     application.add_handler(admin_conv)
     
@@ -980,12 +3001,62 @@ def main() -> None:
     
     # Admin key/history commands
     application.add_handler(CommandHandler("add_key", add_key))
+    application.add_handler(CommandHandler("add_keys", add_keys))
+    # Bulk key files: plain text only, anything else would be imported as garbage keys
+    key_files = filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv")
+    application.add_handler(MessageHandler(key_files & filters.CaptionRegex(r"^/add_keys\b"), add_keys))
     application.add_handler(CommandHandler("list_keys", list_keys))
     application.add_handler(CommandHandler("remove_key", remove_key))
+    application.add_handler(CommandHandler("remove_keys", remove_keys))
+    application.add_handler(MessageHandler(key_files & filters.CaptionRegex(r"^/remove_keys\b"), remove_keys))
+    application.add_handler(CommandHandler("purge_keys", purge_keys))
+    application.add_handler(CallbackQueryHandler(purge_keys_confirm, pattern="^purge_keys::"))
     application.add_handler(CommandHandler("history", history))
     application.add_handler(CommandHandler("export_history", export_history))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("pending", pending_orders))
+    application.add_handler(CommandHandler("approve_batch", approve_batch))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import_ledger\b"), import_ledger_cmd))
+    application.add_handler(CommandHandler("import_ledger", import_ledger_cmd))
+    application.add_handler(CallbackQueryHandler(pending_page_cb, pattern="^pending:"))
+    application.add_handler(CallbackQueryHandler(approve_order, pattern="^pending_approve_"))
+    application.add_handler(CallbackQueryHandler(reject_order, pattern="^pending_reject_"))
+    
+    instrument_handlers(application)
+    if application.job_queue is None:
+        logger.warning('Stock watcher and order expiry disabled: install "python-telegram-bot[job-queue]"')
+    else:
+        if STOCK_WATCH_INTERVAL:
+            application.job_queue.run_repeating(stock_watch_job, interval=STOCK_WATCH_INTERVAL, first=10, name="stock_watch")
+        if ORDER_EXPIRY_HOURS:
+            application.job_queue.run_repeating(order_sweep_job, interval=ORDER_SWEEP_INTERVAL, first=60, name="order_sweep")
+    Gauge("bot_update_queue_depth", "Updates received but not yet being handled", lambda: update_queue_depth(application))
+    Gauge("bot_updates_running", "Updates currently being handled", lambda: application.update_processor.running)
+    
+    loop = asyncio.get_event_loop()
+    if METRICS_PORT:
+        try:
+            loop.run_until_complete(serve_http({("GET", "/metrics"): metrics_route}, METRICS_LISTEN, METRICS_PORT))
+            logger.info(f"Metrics served on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.warning(f"Metrics disabled, cannot listen on {METRICS_LISTEN}:{METRICS_PORT}: {e}")
     
-    application.run_polling()
+    # Handlers are registered above; initialize() here makes run_polling()/run_webhook() skip it
+    loop.run_until_complete(startup(application))
+    
+    if BOT_MODE == "webhook":
+        loop.run_until_complete(run_webhook(application))
+    else:
+        application.run_polling()
+
+async def migrate() -> None:
+    global DB_MIGRATE_ON_START
+    DB_MIGRATE_ON_START = True
+    await init_db_pool()
+    await db_pool.close()
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["migrate"]:
+        asyncio.run(migrate())
+    else:
+        main()
@@ -0,0 +1,69 @@
+"""Post a synthetic Telegram update to a locally running webhook-mode bot.
+
+Usage:
+    BOT_MODE=webhook WEBHOOK_SECRET=s python bot.py   # WEBHOOK_URL unset = local mode
+    WEBHOOK_SECRET=s python fake_update.py "/start" --user 123456
+    WEBHOOK_SECRET=s python fake_update.py --callback product_bgmi --user 123456
+"""
+import argparse
+import json
+import os
+import random
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def build_update(args) -> dict:
+    user = {"id": args.user, "is_bot": False, "first_name": "Fake", "username": "fake_user"}
+    chat = {"id": args.user, "type": "private", "first_name": "Fake"}
+    message = {
+        "message_id": random.randint(1, 2**31),
+        "date": int(time.time()),
+        "chat": chat,
+        "from": user,
+    }
+    update_id = random.randint(1, 2**31)
+    if args.callback:
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": user,
+                "chat_instance": str(args.user),
+                "message": {**message, "text": "menu"},
+                "data": args.callback,
+            },
+        }
+    text = args.text or ""
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": {**message, "text": text}}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("text", nargs="?", help="message text, e.g. /start")
+    parser.add_argument("--callback", help="send a callback query with this data instead of a message")
+    parser.add_argument("--user", type=int, default=1, help="fake user/chat id")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8443')}{os.getenv('WEBHOOK_PATH', '/telegram')}")
+    args = parser.parse_args()
+
+    req = urllib.request.Request(
+        args.url,
+        data=json.dumps(build_update(args)).encode(),
+        headers={
+            "Content-Type": "application/json",
+            "X-Telegram-Bot-Api-Secret-Token": os.getenv("WEBHOOK_SECRET", ""),
+        },
+        method="POST",
+    )
+    with urllib.request.urlopen(req) as resp:
+        print(resp.status, resp.read().decode())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+from decimal import Decimal
+
+import bot
+
+
+def test_signed_single_column_amounts():
+    raw = (
+        "UTR,Amount\n"
+        "111111111111,499.00\n"
+        "222222222222,-499.00\n"
+        "333333333333,+120\n"
+    )
+    assert bot.parse_ledger_csv(raw) == [
+        ("111111111111", Decimal("499.00"), None),
+        ("333333333333", Decimal("120"), None),
+    ]
+
+
+def test_dr_cr_column_and_suffixes_skip_debits():
+    raw = (
+        "Transaction ID,Dr/Cr,Amount\n"
+        "AAA1,CR,\"₹1,499.00\"\n"
+        "AAA2,DR,499.00\n"
+        "AAA3,,499.00 Dr\n"
+        "AAA4,,(299.00)\n"
+        "AAA5,,Rs. 299 Cr\n"
+    )
+    assert bot.parse_ledger_csv(raw) == [
+        ("AAA1", Decimal("1499.00"), None),
+        ("AAA5", Decimal("299"), None),
+    ]
+
+
+def test_preamble_above_header_and_unparsable_rows():
+    raw = (
+        "Account statement for XXXX1234\n"
+        "Period,01-10-2026,31-10-2026\n"
+        "\n"
+        "Date,Description,UPI Ref No,Amount\n"
+        "2026-10-01,UPI/alice,4123 4567 8901,499.00\n"
+        "2026-10-02,UPI/bob,412345678902,n/a\n"
+        "2026-10-03,UPI/carol,412345678903,0\n"
+    )
+    assert bot.parse_ledger_csv(raw) == [("412345678901", Decimal("499.00"), "UPI/alice")]
+
+
+def test_no_header_found():
+    assert bot.parse_ledger_csv("just,some\nrandom,rows\n") == []
+
+
+def test_parse_ledger_amount():
+    assert bot.parse_ledger_amount("-499.00") == Decimal("-499.00")
+    assert bot.parse_ledger_amount("INR 2,000") == Decimal("2000")
+    assert bot.parse_ledger_amount("12-34") is None
+    assert bot.parse_ledger_amount("") is None
@@ -0,0 +1,20 @@
+import uuid
+from datetime import datetime
+
+import bot
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2026, 10, 18, 1, 47, 42, 783123)
+    order_id = uuid.uuid4()
+    assert bot._decode_cursor(bot._encode_cursor(created_at, order_id)) == (created_at, order_id)
+
+
+def test_first_cursor_round_trip():
+    assert bot._decode_cursor(bot._encode_cursor(*bot._FIRST_CURSOR)) == bot._FIRST_CURSOR
+
+
+def test_cursor_fits_callback_data():
+    # The longest cursor (max timestamp, 32 hex digits) behind the longest nav prefix
+    cursor = bot._encode_cursor(datetime.max, uuid.UUID(int=2**128 - 1))
+    assert len(f"pending:>:{cursor}".encode()) <= 64
@@ -0,0 +1,36 @@
+import pytest
+
+import bot
+
+
+def walk(counts):
+    """Feed counts through stock_level like stock_watch_job does; return the
+    level after each count and the counts that raised an alert."""
+    previous, levels, alerts = "ok", [], []
+    for count in counts:
+        level = bot.stock_level(count, previous)
+        if bot.STOCK_LEVELS.index(level) > bot.STOCK_LEVELS.index(previous):
+            alerts.append((count, level))
+        levels.append(level)
+        previous = level
+    return levels, alerts
+
+
+@pytest.fixture(autouse=True)
+def thresholds(monkeypatch):
+    monkeypatch.setattr(bot, "LOW_STOCK_THRESHOLD", 5)
+    monkeypatch.setattr(bot, "LOW_STOCK_HYSTERESIS", 2)
+
+
+@pytest.mark.parametrize("counts, levels, alerts", [
+    # ok -> low -> ok: "low" only re-arms above threshold + hysteresis (7)
+    ([10, 5, 6, 7, 8], ["ok", "low", "low", "low", "ok"], [(5, "low")]),
+    ([8, 4, 9, 3], ["ok", "low", "ok", "low"], [(4, "low"), (3, "low")]),
+    # A plan hovering around zero alerts once
+    ([10, 0, 1, 0, 2, 0], ["ok", "out", "out", "out", "out", "out"], [(0, "out")]),
+    # "out" re-arms once the count climbs above the hysteresis
+    ([0, 3, 0], ["out", "low", "out"], [(0, "out"), (0, "out")]),
+    ([0, 3, 8, 4], ["out", "low", "ok", "low"], [(0, "out"), (4, "low")]),
+])
+def test_stock_level_sequences(counts, levels, alerts):
+    assert walk(counts) == (levels, alerts)
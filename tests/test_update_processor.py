@@ -0,0 +1,44 @@
+import asyncio
+import random
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+import bot
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=user_id, type="private"),
+        from_user=User(id=user_id, first_name="u", is_bot=False),
+    )
+    return Update(update_id=update_id, message=message)
+
+
+def test_same_user_updates_run_in_order_and_users_overlap():
+    async def scenario():
+        processor = bot.OrderedUpdateProcessor(workers=4)
+        finished = []
+        active, peak = 0, 0
+
+        async def handle(update: Update) -> None:
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(random.uniform(0, 0.01))
+            active -= 1
+            finished.append((update.effective_user.id, update.update_id))
+
+        updates = [make_update(i, user_id=i % 3) for i in range(30)]
+        await asyncio.gather(*(processor.do_process_update(u, handle(u)) for u in updates))
+        return processor, finished, peak
+
+    processor, finished, peak = asyncio.run(scenario())
+    for user_id in range(3):
+        ids = [update_id for uid, update_id in finished if uid == user_id]
+        assert ids == sorted(ids)
+    assert peak > 1
+    assert processor.queued == processor.running == 0
+    assert not processor._locks and not processor._refs